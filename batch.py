@@ -0,0 +1,189 @@
+"""
+Headless batch processing: streams a folder (or glob) of images through the LCM inference engine.
+
+Inputs are decoded ahead of time by a pool of reader threads and outputs are encoded and written by a pool of
+writer threads, so that the denoiser never waits on disk.
+
+Example:
+    python batch.py "captures/*.png" -o results -p "An architectural render of a building" --steps 4
+    python batch.py captures -o results --stub   # no model, CPU only (throughput tests)
+    python batch.py captures -o results --device cpu --threads 16 --size 384 384
+    python batch.py captures -o results --server default   # use the model of a running server.py
+"""
+
+import argparse
+import glob
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from PIL import Image
+
+import lcm
+import resources as res
+
+IMG_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+
+def list_inputs(source):
+    """
+    Returns the sorted image files of a folder, or matching a glob pattern
+    """
+    if os.path.isdir(source):
+        paths = [os.path.join(source, f) for f in os.listdir(source)]
+    else:
+        paths = glob.glob(source)
+    return sorted(p for p in paths if p.lower().endswith(IMG_EXTENSIONS))
+
+
+def decode(img_path, size=None):
+    im = Image.open(img_path).convert('RGB')
+    if size is not None and im.size != size:
+        im = im.resize(size, Image.BICUBIC)
+    return im
+
+
+def prefetch(paths, read_fn, pool, lookahead):
+    """
+    Yields (path, result) in order, while up to 'lookahead' next items are being read by the pool
+    """
+    it = iter(paths)
+    pending = deque((p, pool.submit(read_fn, p)) for p in islice(it, lookahead))
+    while pending:
+        p, future = pending.popleft()
+        nxt = next(it, None)
+        if nxt is not None:
+            pending.append((nxt, pool.submit(read_fn, nxt)))
+        yield p, future.result()
+
+
+def run_batch(paths, out_dir, infer, infer_args, size=None, n_readers=2, n_writers=2, lookahead=8, fmt='png'):
+    """
+    Runs the inference on all paths and writes the results in out_dir.
+    :return: (dict) statistics of the run
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    # bound the number of images waiting to be written
+    write_slots = threading.Semaphore(lookahead)
+    infer_time = 0.
+    n = 0
+
+    def write(im, out_path):
+        try:
+            if fmt == 'jpg':
+                im.save(out_path, 'JPEG', quality=95)
+            else:
+                im.save(out_path)
+        finally:
+            write_slots.release()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(n_readers) as readers, ThreadPoolExecutor(n_writers) as writers:
+        write_jobs = []
+        for img_path, im in prefetch(paths, lambda p: decode(p, size), readers, lookahead):
+            t0 = time.perf_counter()
+            out = infer(image=im, **infer_args)
+            infer_time += time.perf_counter() - t0
+            n += 1
+
+            out_name = os.path.splitext(os.path.basename(img_path))[0] + '.' + fmt
+            write_slots.acquire()
+            write_jobs.append(writers.submit(write, out, os.path.join(out_dir, out_name)))
+
+        for job in write_jobs:
+            job.result()  # raise writing errors, if any
+    total_time = time.perf_counter() - start
+
+    return {
+        'images': n,
+        'total_time': total_time,
+        'inference_time': infer_time,
+        'images_per_second': n / total_time if total_time else 0.,
+        'denoiser_busy': infer_time / total_time if total_time else 0.
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FocusPocus headless batch inference")
+    parser.add_argument('input', help="folder or glob pattern of input images")
+    parser.add_argument('-o', '--output', default='batch_output', help="output folder")
+    parser.add_argument('-p', '--prompt', default='An architectural render of a building')
+    parser.add_argument('-n', '--negative', default='')
+    parser.add_argument('--steps', type=int, default=4)
+    parser.add_argument('--cfg', type=float, default=1.)
+    parser.add_argument('--strength', type=float, default=0.9)
+    parser.add_argument('--seed', type=int, default=1337)
+    parser.add_argument('--model', default='Dreamshaper7', help=f"one of {lcm.model_list} or a hugging face id")
+    parser.add_argument('--ip-ref', default=None,
+                        help="IP-Adapter reference image (a path, or 1-8 for the built-in styles)")
+    parser.add_argument('--ip-scale', type=float, default=1.)
+    parser.add_argument('--size', type=int, nargs=2, default=None, metavar=('W', 'H'),
+                        help="resize inputs before inference")
+    parser.add_argument('--tiled', action='store_true',
+                        help="denoise large images in tiles, with a bounded memory (e.g. A3 renders)")
+    parser.add_argument('--format', choices=['png', 'jpg'], default='png')
+    parser.add_argument('--readers', type=int, default=2, help="number of decoding threads")
+    parser.add_argument('--writers', type=int, default=2, help="number of encoding/writing threads")
+    parser.add_argument('--lookahead', type=int, default=8, help="number of images decoded in advance")
+    parser.add_argument('--device', default=None, help="cuda, mps or cpu (default: cuda if available)")
+    parser.add_argument('--threads', type=int, default=None, help="number of CPU threads, for --device cpu")
+    parser.add_argument('--compile', action='store_true', help="torch.compile the UNet, for --device cpu")
+    parser.add_argument('--server', default=None,
+                        help="address of a running inference server ('default' for the default one), see server.py")
+    parser.add_argument('--stub', action='store_true', help="use a stub pipeline on the CPU (no model)")
+    parser.add_argument('--stub-delay', type=float, default=0., help="simulated time per step of the stub (s)")
+    args = parser.parse_args(argv)
+
+    paths = list_inputs(args.input)
+    if not paths:
+        parser.error(f'no image found in {args.input}')
+
+    ip_ref_img = args.ip_ref
+    if ip_ref_img is not None and ip_ref_img.isdigit():
+        ip_ref_img = res.find(f'img/ref{ip_ref_img}.png')
+    use_ip = ip_ref_img is not None
+
+    if args.server:
+        import server
+
+        infer = server.InferenceClient(args.server).get_infer(lcm.resolve_model_id(args.model), use_ip)
+    elif args.stub:
+        infer = lcm.load_stub_models(delay=args.stub_delay)
+    else:
+        if args.threads:
+            lcm.cpu_threads = args.threads
+        if args.compile:
+            lcm.cpu_compile = True
+        infer = lcm.load_models(model_id=lcm.resolve_model_id(args.model), use_ip=use_ip,
+                                ip_ref_img=ip_ref_img or res.find('img/ref1.png'), device=args.device)
+
+    infer_args = dict(
+        prompt=args.prompt,
+        negative_prompt=args.negative,
+        num_inference_steps=args.steps,
+        guidance_scale=args.cfg,
+        strength=args.strength,
+        seed=args.seed,
+        ip_scale=args.ip_scale
+    )
+    if args.tiled:
+        infer_args['tiled'] = True
+    if use_ip:
+        infer_args['ip_ref_img'] = ip_ref_img
+
+    stats = run_batch(paths, args.output, infer, infer_args, size=tuple(args.size) if args.size else None,
+                      n_readers=args.readers, n_writers=args.writers, lookahead=args.lookahead, fmt=args.format)
+
+    print(f"{stats['images']} images in {stats['total_time']:.2f}s "
+          f"({stats['images_per_second']:.2f} img/s, denoiser busy {stats['denoiser_busy']:.0%})")
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,333 @@
+"""
+Per-stage latency benchmark of the FocusPocus loop.
+
+Measured stages: screen grab, webcam grab (optional), scene rasterization, image conversion, VAE encode, UNet steps,
+VAE decode, post-processing and display. Runs against a tiny random-weight pipeline on the CPU (default) or a real
+model. Results (mean/p50/p95 in ms) are written to a JSON file, and can be compared to a previous (baseline) run.
+
+Example:
+    python bench.py -o bench.json
+    python bench.py --model Dreamshaper7 --size 512 512 -o bench_gpu.json
+    python bench.py -o new.json --baseline bench.json --tolerance 0.15
+    python bench.py --device cpu --threads 8 --bf16 --cpu-tuning -o bench_cpu.json
+    python bench.py --model Dreamshaper7 --size 2048 2048 --tiled -o bench_tiled.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from contextlib import contextmanager
+
+if not os.environ.get('DISPLAY') and sys.platform.startswith('linux'):
+    # headless machines
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PySide6.QtCore import *
+from PySide6.QtGui import *
+from PySide6.QtWidgets import *
+
+import torch
+
+import capture
+import imaging
+import lcm
+import metrics
+import widgets as wid
+
+
+class StageSamples:
+    """
+    Collects durations (ms) per stage, in the histograms of a metrics registry sized for the whole run
+    """
+    def __init__(self, sync=None, size=100000):
+        self.sync = sync
+        self.size = size
+        self.clear()
+
+    @contextmanager
+    def measure(self, stage):
+        if self.sync is not None:
+            self.sync()
+        start = time.perf_counter()
+        yield
+        if self.sync is not None:
+            self.sync()
+        self.registry.observe(stage, (time.perf_counter() - start) * 1000)
+
+    def add(self, stage, ms):
+        self.registry.observe(stage, ms)
+
+    def clear(self):
+        self.registry = metrics.MetricsRegistry(histogram_size=self.size)
+
+    def summary(self):
+        with self.registry.lock:
+            stages = list(self.registry.histograms)
+        return {stage: self.registry.histogram(stage) for stage in stages}
+
+
+def instrument_pipeline(pipe, samples):
+    """
+    Wraps the VAE, UNet and post-processing of a diffusers pipeline to time them separately
+    """
+    vae = pipe.vae
+    vae_encode, vae_decode = vae.encode, vae.decode
+    postprocess = pipe.image_processor.postprocess
+
+    def encode(*args, **kwargs):
+        with samples.measure('vae_encode'):
+            return vae_encode(*args, **kwargs)
+
+    def decode(*args, **kwargs):
+        with samples.measure('vae_decode'):
+            return vae_decode(*args, **kwargs)
+
+    def post(*args, **kwargs):
+        with samples.measure('postprocess'):
+            return postprocess(*args, **kwargs)
+
+    vae.encode = encode
+    vae.decode = decode
+    pipe.image_processor.postprocess = post
+
+    starts = []
+
+    def unet_pre(module, args):
+        if samples.sync is not None:
+            samples.sync()
+        starts.append(time.perf_counter())
+
+    def unet_post(module, args, output):
+        if samples.sync is not None:
+            samples.sync()
+        samples.add('unet_step', (time.perf_counter() - starts.pop()) * 1000)
+
+    pipe.unet.register_forward_pre_hook(unet_pre)
+    pipe.unet.register_forward_hook(unet_post)
+
+
+def draw_test_strokes(canvas, n_strokes=20):
+    """
+    Fills the canvas with some brush strokes and shapes, like a user would do
+    """
+    w, h = canvas.w, canvas.h
+    for i in range(n_strokes):
+        canvas.last_point = QPoint(int(w * i / n_strokes), 10)
+        for j in range(10):
+            canvas.draw_line(QPoint(int(w * i / n_strokes) + 3 * j, int(h * j / 10)))
+    canvas.draw_rectangle(QPointF(w * 0.2, h * 0.5), QPointF(w * 0.6, h * 0.9))
+    canvas.draw_ellipse(QPointF(w * 0.5, h * 0.1), QPointF(w * 0.9, h * 0.4))
+
+
+def load_pipeline(model_id, device, bf16=False):
+    if model_id == 'tiny':
+        pipe = lcm.build_tiny_pipeline()
+    else:
+        pipe = lcm.build_pipeline(model_id=model_id, use_ip=False, device=device)
+    pipe.to(device=device)
+    if bf16:
+        pipe.to(dtype=torch.bfloat16)
+    return pipe
+
+
+def run_benchmark(args):
+    device = args.device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    sync = torch.cuda.synchronize if device == 'cuda' else None
+    samples = StageSamples(sync=sync)
+    size = tuple(args.size)
+
+    app = QApplication.instance() or QApplication([])
+
+    canvas = wid.Canvas(size)
+    result_canvas = wid.simpleCanvas(size)
+    canvas.show()
+    result_canvas.show()
+    draw_test_strokes(canvas)
+    app.processEvents()
+
+    if device == 'cpu':
+        lcm.configure_cpu(args.threads)
+    model_id = lcm.resolve_model_id(args.model)
+    pipe = load_pipeline(model_id, device, bf16=args.bf16)
+    if args.cpu_tuning or args.compile:
+        lcm.tune_for_cpu(pipe, compile_unet=args.compile)
+    tiny_vae = None
+    if args.fast_vae:
+        tiny_vae = lcm.get_tiny_vae(model_id, device, dtype=pipe.vae.dtype, random_weights=args.model == 'tiny')
+    vae = tiny_vae if tiny_vae is not None else pipe.vae
+    vae_weights_mb = sum(p.numel() * p.element_size() for p in vae.parameters()) / 2**20
+
+    # timing wrappers are installed on the VAE that will actually be used
+    with lcm.use_vae(pipe, tiny_vae):
+        instrument_pipeline(pipe, samples)
+    infer = lcm.make_infer(pipe, model_id, use_ip=False, device=device, tiny_vae=tiny_vae)
+    if device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+
+    webcam = None
+    if args.webcam:
+        # same camera thread as the application: the measured grab is the cost of taking the newest frame
+        webcam = capture.WebcamCapture(0, size=size)
+        webcam.start()
+        deadline = time.perf_counter() + 5
+        while webcam.ring.seq == 0 and webcam.thread.is_alive() and time.perf_counter() < deadline:
+            time.sleep(0.05)
+        if webcam.ring.seq == 0:
+            print('no webcam found, skipping webcam grab')
+            webcam.stop()
+            webcam = None
+
+    # same grab as the capture thread of the application
+    grabber = capture.make_backend(args.capture_backend)
+    grabber.open()
+    ring = capture.FrameRing()
+
+    for i in range(args.warmup + args.iterations):
+        if i == args.warmup:
+            samples.clear()
+
+        iteration_start = time.perf_counter()
+
+        with samples.measure('screen_grab'):
+            index, frame = ring.slot((size[1], size[0], 3))
+            grabber.grab((0, 0) + size, frame)
+            ring.commit(index)
+
+        if webcam is not None:
+            with samples.measure('webcam_grab'):
+                webcam.latest()
+
+        with samples.measure('rasterize'):
+            qimage = imaging.render_view(canvas)
+
+        with samples.measure('to_pil'):
+            im = imaging.qimage_to_pil(qimage)
+
+        with samples.measure('inference'):
+            out = infer(
+                prompt=args.prompt,
+                negative_prompt='',
+                image=im,
+                num_inference_steps=args.steps,
+                guidance_scale=1,
+                strength=args.strength,
+                seed=1337,
+                fast_vae=args.fast_vae,
+                stream=args.stream,
+                tiled=args.tiled
+            )
+        if out is None:
+            # stream batching: the first frames are still in flight
+            continue
+
+        with samples.measure('display'):
+            result_canvas.setPhoto(pixmap=imaging.pil_to_qpixmap(out))
+            result_canvas.viewport().repaint()
+            app.processEvents()
+
+        # the 'total' entry is the whole iteration
+        samples.add('total', (time.perf_counter() - iteration_start) * 1000)
+
+    grabber.close()
+    if webcam is not None:
+        webcam.stop()
+
+    return {
+        'meta': {
+            'model': args.model,
+            'device': device,
+            'size': size,
+            'steps': args.steps,
+            'strength': args.strength,
+            'iterations': args.iterations,
+            'fast_vae': args.fast_vae,
+            'stream': args.stream,
+            'tiled': args.tiled,
+            'capture_backend': args.capture_backend,
+            'dtype': str(pipe.unet.dtype),
+            'threads': torch.get_num_threads() if device == 'cpu' else None,
+            'cpu_tuning': args.cpu_tuning,
+            'compile': args.compile,
+            'vae_weights_mb': vae_weights_mb,
+            'peak_memory_mb': torch.cuda.max_memory_allocated() / 2**20 if device == 'cuda' else None,
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        },
+        'stages': samples.summary()
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares the p50 of each stage to a baseline run.
+    :return: list of (stage, baseline p50, new p50, ratio) for the regressions
+    """
+    regressions = []
+    print(f"{'stage':<14}{'baseline p50':>14}{'p50':>10}{'change':>10}")
+    for stage, stats in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        old = baseline['stages'][stage]['p50']
+        new = stats['p50']
+        ratio = new / old if old > 0 else 1.
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append((stage, old, new, ratio))
+        print(f"{stage:<14}{old:>14.2f}{new:>10.2f}{ratio - 1:>+10.0%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FocusPocus per-stage latency benchmark")
+    parser.add_argument('--model', default='tiny',
+                        help=f"'tiny' (random weights, CPU friendly), one of {lcm.model_list} or a hugging face id")
+    parser.add_argument('--device', default=None, help="cuda, mps or cpu (default: cuda if available)")
+    parser.add_argument('--size', type=int, nargs=2, default=[256, 256], metavar=('W', 'H'))
+    parser.add_argument('--steps', type=int, default=4)
+    parser.add_argument('--strength', type=float, default=0.9)
+    parser.add_argument('--prompt', default='An architectural render of a building')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--webcam', action='store_true', help="also measure the webcam grab")
+    parser.add_argument('--capture-backend', default='qt', choices=['auto'] + list(capture.backends),
+                        help="screen grab backend (default: qt)")
+    parser.add_argument('--fast-vae', action='store_true', help="use the tiny autoencoder (TAESD)")
+    parser.add_argument('--stream', action='store_true', help="stream batching of consecutive frames")
+    parser.add_argument('--tiled', action='store_true', help="tiled denoising and VAE (large images)")
+    parser.add_argument('--threads', type=int, default=None, help="number of CPU threads (default: torch default)")
+    parser.add_argument('--bf16', action='store_true', help="bfloat16 weights (CPUs with native bfloat16)")
+    parser.add_argument('--cpu-tuning', action='store_true',
+                        help="channels-last memory format and scaled dot product attention")
+    parser.add_argument('--compile', action='store_true', help="torch.compile the UNet (implies --cpu-tuning)")
+    parser.add_argument('-o', '--output', default='bench.json', help="JSON result file")
+    parser.add_argument('--baseline', default=None, help="JSON result of a previous run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="relative p50 increase considered as a regression (default 10%%)")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print(f"{'stage':<14}{'mean':>10}{'p50':>10}{'p95':>10}   (ms)")
+    for stage, stats in results['stages'].items():
+        print(f"{stage:<14}{stats['mean']:>10.2f}{stats['p50']:>10.2f}{stats['p95']:>10.2f}")
+    print(f'results saved: {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
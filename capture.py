@@ -0,0 +1,428 @@
+"""
+Screen and webcam capture running on their own threads, writing into a ring buffer of preallocated frames.
+
+The capture thread grabs the region at a fixed rate (or reads the camera as fast as it delivers frames) and writes
+into the next slot of the ring. The consumer (inference side) only takes the newest frame: capture can run much faster
+than inference without piling up frames or blocking the GUI thread.
+
+Headless benchmark of the backends:
+    python capture.py --backend synthetic --size 512 512
+    python capture.py --backend mss --size 1024 768 -n 200
+"""
+
+import argparse
+import sys
+import threading
+import time
+
+import numpy as np
+
+import metrics
+
+try:
+    import mss
+except ImportError:
+    mss = None
+
+
+class FrameRing:
+    """
+    Ring buffer of preallocated RGB frames, one writer and any number of readers.
+    The writer fills the slot after the newest one, so a frame being written is never read.
+    """
+    def __init__(self, size=4):
+        self.size = size
+        self.frames = None
+        self.newest = -1
+        self.seq = 0  # number of committed frames
+        self.lock = threading.Lock()
+
+    def slot(self, shape):
+        """
+        Returns (index, array) of the slot to write next. The frames are allocated again if the shape changes
+        """
+        with self.lock:
+            if self.frames is None or self.frames[0].shape != shape:
+                self.frames = [np.zeros(shape, dtype=np.uint8) for _ in range(self.size)]
+                self.newest = -1
+            index = (self.newest + 1) % self.size
+            return index, self.frames[index]
+
+    def commit(self, index):
+        with self.lock:
+            self.newest = index
+            self.seq += 1
+
+    def latest(self, after=0):
+        """
+        Returns (sequence number, copy of the newest frame), the frame being None if there is no frame newer than
+        the sequence number 'after'
+        """
+        with self.lock:
+            if self.seq <= after or self.newest < 0:
+                return self.seq, None
+            return self.seq, self.frames[self.newest].copy()
+
+
+class CaptureBackend:
+    """
+    Grabs a screen region into a preallocated (h, w, 3) RGB array. open and close are called from the capture thread
+    """
+    name = None
+    threaded = True  # False: the backend can only be used from the GUI thread
+    pixel_ratio = 1.  # physical pixels per logical (Qt) pixel of the screen, set from the GUI thread
+
+    def open(self):
+        pass
+
+    def grab(self, region, out):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class QtGrabBackend(CaptureBackend):
+    """
+    QScreen.grabWindow. Needs a QApplication, and creates a QPixmap: it only runs on the GUI thread
+    """
+    name = 'qt'
+    threaded = False
+
+    def grab(self, region, out):
+        from PySide6.QtCore import Qt
+        from PySide6.QtGui import QImage
+        from PySide6.QtWidgets import QApplication
+        import imaging
+
+        x, y, w, h = region
+        screen = QApplication.primaryScreen()
+        image = screen.grabWindow(0, x, y, w, h).toImage()
+        if image.width() != w or image.height() != h:
+            # high DPI screens
+            image = image.scaled(w, h, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        out[...] = imaging.qimage_to_array(image.convertToFormat(QImage.Format_RGBX8888))
+
+
+class MSSBackend(CaptureBackend):
+    """
+    mss (XShm on Linux, BitBlt on Windows, CoreGraphics on macOS): no Qt objects, only a copy of the raw pixels
+    """
+    name = 'mss'
+
+    def __init__(self):
+        if mss is None:
+            raise ImportError('mss is not installed (pip install mss)')
+        self.sct = None
+
+    def open(self):
+        # mss instances can only be used from the thread which created them
+        self.sct = mss.mss()
+
+    def grab(self, region, out):
+        x, y, w, h = region
+        # the region is in logical pixels, mss grabs physical pixels (except on macOS, where it takes points)
+        r = 1. if sys.platform == 'darwin' else self.pixel_ratio
+        shot = self.sct.grab({'left': round(x * r), 'top': round(y * r),
+                              'width': round(w * r), 'height': round(h * r)})
+        bgra = np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+        if shot.width != w or shot.height != h:
+            # high DPI screens: back to the logical size
+            import cv2
+            bgra = cv2.resize(bgra, (w, h), interpolation=cv2.INTER_AREA)
+        out[...] = bgra[:h, :w, 2::-1]
+
+    def close(self):
+        if self.sct is not None:
+            self.sct.close()
+            self.sct = None
+
+
+class SyntheticBackend(CaptureBackend):
+    """
+    Moving color pattern, for tests and benchmarks without a screen
+    """
+    name = 'synthetic'
+
+    def __init__(self, speed=4):
+        self.speed = speed
+        self.t = 0
+
+    def grab(self, region, out):
+        _, _, w, h = region
+        self.t += self.speed
+        xs = (np.arange(w, dtype=np.uint16) + self.t) % 256
+        ys = (np.arange(h, dtype=np.uint16) + self.t // 2) % 256
+        out[:, :, 0] = xs[None, :]
+        out[:, :, 1] = ys[:, None]
+        out[:, :, 2] = ((xs[None, :] + ys[:, None]) // 2).astype(np.uint8)
+
+
+backends = {b.name: b for b in (QtGrabBackend, MSSBackend, SyntheticBackend)}
+
+
+def make_backend(name='auto'):
+    """
+    :param name: 'qt', 'mss', 'synthetic' or 'auto' (mss if installed, else qt)
+    """
+    if name == 'auto':
+        name = 'mss' if mss is not None else 'qt'
+    return backends[name]()
+
+
+class ScreenCapture:
+    """
+    Grabs a region of the screen at a fixed rate from a background thread, into a FrameRing.
+    Backends which are not thread-safe (Qt) grab on the GUI thread instead, when poll is called
+    """
+    def __init__(self, backend='auto', fps=30., ring_size=4):
+        self.backend = make_backend(backend) if isinstance(backend, str) else backend
+        self.interval = 1 / fps
+        self.ring = FrameRing(ring_size)
+        self.region = None  # (x, y, w, h)
+
+        self.n_frames = 0
+        self.n_failed = 0
+
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    @property
+    def threaded(self):
+        return self.backend.threaded
+
+    def start(self):
+        if self.threaded:
+            self.thread.start()
+        else:
+            self.backend.open()
+
+    def set_region(self, region, pixel_ratio=1.):
+        """
+        :param region: (x, y, w, h) in logical pixels
+        :param pixel_ratio: device pixel ratio of the screen showing the region (QScreen.devicePixelRatio)
+        """
+        self.backend.pixel_ratio = pixel_ratio
+        # a tuple is replaced atomically, no lock needed
+        self.region = tuple(region)
+
+    def poll(self):
+        """
+        Grabs a frame now, from the calling (GUI) thread, if the backend does not run on the capture thread
+        """
+        if not self.threaded:
+            self._grab()
+
+    def latest(self, after=0):
+        """
+        See FrameRing.latest
+        """
+        return self.ring.latest(after)
+
+    def _grab(self):
+        region = self.region
+        if region is None or region[2] <= 0 or region[3] <= 0:
+            return
+        index, out = self.ring.slot((region[3], region[2], 3))
+        try:
+            with metrics.registry.timed('capture'):
+                self.backend.grab(region, out)
+        except Exception as e:
+            if self.n_failed == 0:
+                print(f'screen capture failed ({self.backend.name}): {e}')
+            self.n_failed += 1
+        else:
+            self.ring.commit(index)
+            self.n_frames += 1
+            metrics.registry.mark('capture')
+
+    def _run(self):
+        self.backend.open()
+        try:
+            next_time = time.perf_counter()
+            while not self._stop.is_set():
+                self._grab()
+
+                # fixed rate, without catching up after a slow grab
+                next_time = max(next_time + self.interval, time.perf_counter())
+                self._stop.wait(next_time - time.perf_counter())
+        finally:
+            self.backend.close()
+
+    def stop(self):
+        self._stop.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        elif not self.threaded:
+            self.backend.close()
+
+
+class WebcamCapture:
+    """
+    Reads a camera from a background thread, as fast as it delivers frames, and keeps the latest ones in a FrameRing.
+
+    The device buffer is always drained, so the served frame is the freshest one (reading at the inference pace
+    returns frames buffered seconds ago). Each frame is cropped to the output aspect ratio, resized to the output
+    size, flipped (inverse) and converted to RGB in a single resize and a single strided copy.
+    """
+    def __init__(self, index=0, size=(512, 512), resolution=(1280, 720), fps=30, ring_size=3):
+        """
+        :param size: (w, h) output frame size
+        :param resolution: (w, h) resolution requested to the camera, None for the default one
+        :param fps: frame rate requested to the camera, None for the default one
+        """
+        self.index = index
+        self.size = tuple(size)
+        self.resolution = resolution
+        self.fps = fps
+        self.inverse = False  # 180 degrees rotation, can be changed while running
+        self.ring = FrameRing(ring_size)
+        self.resized = None
+
+        self.n_read = 0
+        self.n_served = 0
+        self.n_failed = 0
+
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    @property
+    def n_dropped(self):
+        # frames overwritten before being served
+        return max(0, self.ring.seq - self.n_served)
+
+    def start(self):
+        self.thread.start()
+
+    def set_size(self, size):
+        self.size = tuple(size)
+
+    def latest(self, after=0):
+        """
+        See FrameRing.latest
+        """
+        seq, frame = self.ring.latest(after)
+        if frame is not None:
+            self.n_served += 1
+            metrics.registry.increment('webcam_served')
+        return seq, frame
+
+    def process(self, frame, out):
+        """
+        Center crop, resize, flip and BGR to RGB conversion of a camera frame into the (h, w, 3) output array
+        """
+        import cv2
+
+        h, w = out.shape[:2]
+        fh, fw = frame.shape[:2]
+        # crop to the aspect ratio of the output (a view, no copy)
+        if fw * h > fh * w:
+            cw = fh * w // h
+            x0 = (fw - cw) // 2
+            frame = frame[:, x0:x0 + cw]
+        else:
+            ch = fw * h // w
+            y0 = (fh - ch) // 2
+            frame = frame[y0:y0 + ch]
+
+        if self.resized is None or self.resized.shape != out.shape:
+            self.resized = np.empty_like(out)
+        cv2.resize(frame, (w, h), dst=self.resized, interpolation=cv2.INTER_AREA)
+
+        if self.inverse:
+            out[...] = self.resized[::-1, ::-1, ::-1]
+        else:
+            out[...] = self.resized[:, :, ::-1]
+
+    def _run(self):
+        import cv2
+
+        camera = cv2.VideoCapture(self.index)
+        camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        if self.resolution is not None:
+            camera.set(cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0])
+            camera.set(cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1])
+        if self.fps is not None:
+            camera.set(cv2.CAP_PROP_FPS, self.fps)
+        if not camera.isOpened():
+            print(f'camera {self.index} could not be opened')
+            return
+
+        try:
+            while not self._stop.is_set():
+                # blocks until the next frame: the loop follows the camera frame rate
+                ok, frame = camera.read()
+                if not ok:
+                    self.n_failed += 1
+                    self._stop.wait(0.05)
+                    continue
+                self.n_read += 1
+
+                w, h = self.size
+                index, out = self.ring.slot((h, w, 3))
+                with metrics.registry.timed('capture'):
+                    self.process(frame, out)
+                self.ring.commit(index)
+                metrics.registry.mark('capture')
+        finally:
+            camera.release()
+
+    def stop(self):
+        self._stop.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        print(f'webcam: {self.n_read} frames read, {self.n_served} served, {self.n_dropped} dropped')
+
+
+def benchmark(backend='synthetic', size=(512, 512), n=100, origin=(0, 0)):
+    """
+    Measures the grab cost of a backend, without the capture thread
+    :return: (dict) mean/p50/p95 in ms, and the maximum frame rate
+    """
+    backend = make_backend(backend)
+    ring = FrameRing()
+    region = (origin[0], origin[1], size[0], size[1])
+    times = []
+    backend.open()
+    try:
+        for _ in range(n):
+            index, out = ring.slot((size[1], size[0], 3))
+            start = time.perf_counter()
+            backend.grab(region, out)
+            times.append((time.perf_counter() - start) * 1000)
+            ring.commit(index)
+    finally:
+        backend.close()
+
+    times.sort()
+    mean = sum(times) / len(times)
+    return {
+        'backend': backend.name,
+        'n': n,
+        'mean': mean,
+        'p50': times[len(times) // 2],
+        'p95': times[min(len(times) - 1, int(0.95 * len(times)))],
+        'max_fps': 1000 / mean if mean else 0.,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FocusPocus screen capture benchmark")
+    parser.add_argument('--backend', default='synthetic', choices=['auto'] + list(backends))
+    parser.add_argument('--size', type=int, nargs=2, default=[512, 512], metavar=('W', 'H'))
+    parser.add_argument('-n', type=int, default=100, help="number of grabs")
+    args = parser.parse_args(argv)
+
+    app = None
+    if args.backend == 'qt' or (args.backend == 'auto' and mss is None):
+        from PySide6.QtWidgets import QApplication
+        app = QApplication.instance() or QApplication([])
+
+    stats = benchmark(args.backend, tuple(args.size), args.n)
+    print(f"{stats['backend']}: mean {stats['mean']:.2f} ms, p50 {stats['p50']:.2f} ms, p95 {stats['p95']:.2f} ms "
+          f"(max {stats['max_fps']:.0f} FPS)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
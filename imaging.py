@@ -0,0 +1,108 @@
+""" In-memory conversions between Qt images, NumPy arrays and PIL images (no disk round-trips)."""
+
+import numpy as np
+from PIL import Image
+from PySide6.QtCore import Qt
+from PySide6.QtGui import QImage, QPixmap, QPainter
+
+
+def render_view(viewer):
+    """
+    Renders a QGraphicsView (what is visible in its viewport) into an RGBX QImage
+    """
+    image = QImage(viewer.viewport().size(), QImage.Format_RGBX8888)
+    image.fill(Qt.white)
+
+    # Create a QPainter to render the scene into the QImage
+    painter = QPainter(image)
+    viewer.render(painter)
+    painter.end()
+
+    return image
+
+
+def qimage_to_array(qimage):
+    """
+    Returns a (h, w, 3) uint8 RGB array from a QImage.
+    For RGBX8888 / RGBA8888 / RGB888 images the array is a view on the QImage buffer: keep the QImage alive while
+    using it. Other formats are converted, and the array owns its data.
+    :param qimage: (QImage)
+    :return: (np.ndarray)
+    """
+    converted = qimage.format() not in (QImage.Format_RGBX8888, QImage.Format_RGBA8888, QImage.Format_RGB888)
+    if converted:
+        qimage = qimage.convertToFormat(QImage.Format_RGBX8888)
+
+    w, h = qimage.width(), qimage.height()
+    channels = 3 if qimage.format() == QImage.Format_RGB888 else 4
+    buffer = np.frombuffer(qimage.constBits(), dtype=np.uint8)
+    # lines can be padded, use the real line length
+    arr = buffer.reshape(h, qimage.bytesPerLine())[:, :w * channels].reshape(h, w, channels)
+
+    # the converted image is released on return, its pixels must be copied
+    return arr[:, :, :3].copy() if converted else arr[:, :, :3]
+
+
+def qimage_to_pil(qimage):
+    """
+    Converts a QImage to an RGB PIL image (a single copy of the pixel data)
+    """
+    return Image.fromarray(np.ascontiguousarray(qimage_to_array(qimage)), 'RGB')
+
+
+def array_to_qimage(arr):
+    """
+    Wraps a (h, w, 3) uint8 RGB array in a QImage, without copy.
+    The array must stay alive as long as the QImage is used
+    """
+    arr = np.ascontiguousarray(arr)
+    h, w = arr.shape[:2]
+    return QImage(arr.data, w, h, arr.strides[0], QImage.Format_RGB888)
+
+
+def pil_to_qpixmap(pil_img):
+    """
+    Converts a PIL image to a QPixmap, ready to be displayed by a canvas
+    """
+    arr = np.asarray(pil_img.convert('RGB'))
+    # QPixmap.fromImage copies the data, the array can be released afterwards
+    return QPixmap.fromImage(array_to_qimage(arr))
+
+
+class FrameChangeDetector:
+    """
+    Detects if a captured frame is different from the last frame sent to inference.
+
+    Both frames are reduced to a small grayscale thumbnail and compared with the mean absolute difference
+    (0-255 scale), which is robust to sensor noise and compression artifacts.
+    """
+    def __init__(self, threshold=2., size=32):
+        """
+        :param threshold: (float) minimum mean difference for a frame to be considered as changed
+        :param size: (int) side of the thumbnail used for the comparison
+        """
+        self.threshold = threshold
+        self.size = size
+        self.reference = None
+        self.last_difference = None
+
+    def thumbnail(self, frame):
+        if isinstance(frame, np.ndarray):
+            frame = Image.fromarray(frame)
+        small = frame.convert('L').resize((self.size, self.size), Image.BOX)
+        return np.asarray(small, dtype=np.float32)
+
+    def has_changed(self, frame):
+        """
+        Compares a frame (PIL image or RGB array) with the reference frame, without changing the reference
+        """
+        if self.reference is None:
+            return True
+        self.last_difference = float(np.abs(self.thumbnail(frame) - self.reference).mean())
+        return self.last_difference > self.threshold
+
+    def set_reference(self, frame):
+        self.reference = self.thumbnail(frame)
+
+    def reset(self):
+        self.reference = None
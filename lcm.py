@@ -1,12 +1,38 @@
 import os
+import copy
+import gc
+import hashlib
+import importlib
+import json
+import queue
 import random
+import shutil
+import threading
+from collections import Counter, OrderedDict
 from os import path
-from contextlib import nullcontext
+from contextlib import nullcontext, contextmanager
 import time
 from sys import platform
-import torch
-import cv2
 import resources as res
+import metrics
+
+
+class LazyModule:
+    """
+    Module imported on first use. torch and cv2 take seconds to import, the window can show up before
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+torch = LazyModule('torch')
+cv2 = LazyModule('cv2')
 
 """
 All credits to https://github.com/flowtyone/flowty-realtime-lcm-canvas!!
@@ -19,6 +45,11 @@ os.environ["HF_HUB_CACHE"] = cache_path
 os.environ["HF_HOME"] = cache_path
 is_mac = platform == "darwin"
 
+# backend settings, from the environment (e.g. render nodes without GPU: FOCUSPOCUS_DEVICE=cpu)
+device_override = os.environ.get("FOCUSPOCUS_DEVICE")
+cpu_threads = int(os.environ.get("FOCUSPOCUS_THREADS", 0)) or None
+cpu_compile = os.environ.get("FOCUSPOCUS_COMPILE", "0") == "1"
+
 model_list = ['Dreamshaper7', 'SD 1.5','Dreamshaper8','AbsoluteReality', 'RevAnimated','Protogen',  'SDXL 1.0']
 model_ids = [ "Lykon/dreamshaper-7", "runwayml/stable-diffusion-v1-5", "Lykon/dreamshaper-8","Lykon/absolute-reality-1.81", "danbrown/RevAnimated-v1-2-2", "darkstorm2150/Protogen_x5.8_Official_Release", "stabilityai/stable-diffusion-xl-base-1.0"]
 
@@ -40,9 +71,101 @@ def create_video(image_folder, video_name, fps):
     cv2.destroyAllWindows()
     video.release()
 
-def should_use_fp16():
-    if is_mac:
+class VideoRecorder:
+    """
+    Streams frames to a video file from a background thread.
+
+    Frames are pushed in a bounded queue as they are produced and encoded immediately, so stopping the recording
+    only has to flush the last frames. add_frame never blocks: if the encoder cannot keep up, frames are dropped
+    (and counted). Frames can optionally also be written as PNG files.
+    """
+    def __init__(self, video_name, fps=10, png_folder=None, max_queue=64):
+        self.video_name = video_name
+        self.fps = fps
+        self.png_folder = png_folder
+        self.queue = queue.Queue(max_queue)
+        self.writer = None
+        self.size = None
+
+        self.n_frames = 0
+        self.n_dropped = 0
+        self.error = None
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add_frame(self, image):
+        """
+        :param image: (PIL.Image) frame to record
+        """
+        if self.error is not None:
+            self.n_dropped += 1
+            return
+        try:
+            self.queue.put_nowait(image)
+        except queue.Full:
+            self.n_dropped += 1
+
+    def _run(self):
+        try:
+            while True:
+                image = self.queue.get()
+                if image is None:
+                    break
+                self._write(image)
+        except Exception as e:
+            # e.g. disk full: the recording stops, stop() reports it
+            self.error = e
+            print(f'{self.video_name}: recording failed: {e}')
+        finally:
+            if self.writer is not None:
+                self.writer.release()
+
+    def _write(self, image):
+        import numpy as np
+
+        frame = cv2.cvtColor(np.asarray(image.convert('RGB')), cv2.COLOR_RGB2BGR)
+        if self.writer is None:
+            # the first frame gives the video size
+            height, width = frame.shape[:2]
+            self.size = (width, height)
+            fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # For mp4 videos
+            self.writer = cv2.VideoWriter(self.video_name, fourcc, self.fps, self.size)
+        elif (frame.shape[1], frame.shape[0]) != self.size:
+            # image size changed during the recording
+            frame = cv2.resize(frame, self.size)
+
+        self.writer.write(frame)
+        self.n_frames += 1
+
+        if self.png_folder is not None:
+            image.save(os.path.join(self.png_folder, f"frame_{self.n_frames:04}.png"))
+
+    def stop(self):
+        """
+        Finishes encoding the queued frames and closes the video file
+        :return: the exception which stopped the encoder, None if the recording succeeded
+        """
+        # the encoder thread may be gone (see error): nothing drains the queue anymore
+        while self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.thread.join()
+        print(f'{self.video_name}: {self.n_frames} frames recorded, {self.n_dropped} dropped')
+        return self.error
+
+
+def should_use_fp16(device=None):
+    if device is None:
+        device = get_device()
+    if device == "mps":
         return True
+    if device == "cpu":
+        # fp16 kernels are slow (or missing) on CPU, see get_dtype
+        return False
 
     gpu_props = torch.cuda.get_device_properties("cuda")
 
@@ -58,63 +181,897 @@ def should_use_fp16():
     return True
 
 class timer:
-    def __init__(self, method_name="timed process"):
+    """
+    Times a process. The duration (ms) is also recorded in the metrics registry, under the process name
+    :param quiet: (bool) if True, nothing is printed (for per-frame processes)
+    """
+    def __init__(self, method_name="timed process", quiet=False):
         self.method = method_name
+        self.quiet = quiet
 
     def __enter__(self):
         self.start = time.time()
-        print(f"{self.method} starts")
+        if not self.quiet:
+            print(f"{self.method} starts")
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         end = time.time()
-        print(f"{self.method} took {str(round(end - self.start, 2))}s")
+        metrics.registry.observe(self.method, (end - self.start) * 1000)
+        if not self.quiet:
+            print(f"{self.method} took {str(round(end - self.start, 2))}s")
 
 
-def load_models(model_id="runwayml/stable-diffusion-v1-5", use_ip=True, ip_ref_img=res.find('img/ref1.png')):
-    from diffusers import AutoPipelineForImage2Image, LCMScheduler
-    from diffusers.utils import load_image
+def resolve_model_id(model):
+    """
+    Hugging face id of a model given by its display name (e.g. 'SDXL 1.0') or by its id
+    """
+    if model in model_list:
+        return model_ids[model_list.index(model)]
+    return model
 
-    if not is_mac:
-        torch.backends.cuda.matmul.allow_tf32 = True
 
-    use_fp16 = should_use_fp16()
+def get_model_family(model_id):
+    if model_id == "stabilityai/stable-diffusion-xl-base-1.0":
+        return "sdxl"
+    return "sd15"
+
 
+def get_lcm_ids(model_id):
+    """
+    Returns the LCM-LoRA and IP-Adapter weights matching a base model
+    :param model_id: (str) hugging face id of the base model
+    :return: (lcm_lora_id, ip_adapter_name)
+    """
     lcm_lora_id = "latent-consistency/lcm-lora-sdv1-5"
     ip_adapter_name = "ip-adapter_sd15.bin"
     # if stable diffusion XL
-    if model_id == "stabilityai/stable-diffusion-xl-base-1.0":
+    if get_model_family(model_id) == "sdxl":
         lcm_lora_id = "latent-consistency/lcm-lora-sdxl"
         ip_adapter_name = "ip-adapter-plus_sdxl_vit-h.safetensors"
 
-    if use_fp16:
-        pipe = AutoPipelineForImage2Image.from_pretrained(
-            model_id,
-            cache_dir=cache_path,
-            torch_dtype=torch.float16,
-            variant="fp16",
-            safety_checker=None
-        )
-    else:
-        pipe = AutoPipelineForImage2Image.from_pretrained(
-            model_id,
-            cache_dir=cache_path,
-            safety_checker=None
-        )
+    return lcm_lora_id, ip_adapter_name
+
+
+def get_device():
+    if device_override:
+        return device_override
+    if is_mac:
+        return "mps"
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def cpu_supports_bf16():
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def get_dtype(device=None):
+    """
+    Returns the weights dtype for a device: float16 on GPUs that support it, bfloat16 on CPUs with native
+    bfloat16 instructions (AVX512-BF16, AMX), float32 otherwise
+    """
+    if device is None:
+        device = get_device()
+    if device == "cpu":
+        return torch.bfloat16 if cpu_supports_bf16() else torch.float32
+    return torch.float16 if should_use_fp16(device) else torch.float32
+
+
+def configure_cpu(threads=None):
+    """
+    Sets the number of threads used by torch on the CPU (None keeps the default: one per physical core)
+    """
+    if threads:
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(max(1, threads // 4))
+        except RuntimeError:
+            # can only be set before the first parallel work
+            pass
+    print(f'CPU inference: {torch.get_num_threads()} threads')
+
+
+def tune_for_cpu(pipe, compile_unet=False):
+    """
+    CPU execution settings for a pipeline: channels-last memory format for the convolutions, scaled dot product
+    attention (fused kernels) and optionally a compiled UNet
+    """
+    from diffusers.models.attention_processor import AttnProcessor, AttnProcessor2_0
+
+    for module in (pipe.unet, pipe.vae):
+        module.to(memory_format=torch.channels_last)
+
+    # only the classic processors are replaced, IP-Adapter processors are kept
+    processors = pipe.unet.attn_processors
+    if any(type(p) is AttnProcessor for p in processors.values()):
+        pipe.unet.set_attn_processor({
+            name: AttnProcessor2_0() if type(p) is AttnProcessor else p for name, p in processors.items()
+        })
+
+    if compile_unet:
+        with timer("compiling UNet"):
+            pipe.unet = torch.compile(pipe.unet)
+    return pipe
+
+
+def autocast(device, dtype):
+    """
+    Mixed precision context for inference: CUDA autocast, bfloat16 autocast on CPU
+    """
+    if device == "cuda":
+        return torch.autocast("cuda")
+    if device == "cpu" and dtype == torch.bfloat16:
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return nullcontext()
+
+
+def pipeline_size(pipe):
+    """
+    Returns the memory used by the weights of a pipeline, in bytes
+    """
+    size = 0
+    for component in pipe.components.values():
+        if isinstance(component, torch.nn.Module):
+            size += sum(p.numel() * p.element_size() for p in component.parameters())
+    return size
+
+
+def file_hash(file_path):
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FusedPipelineCache:
+    """
+    On-disk snapshots of fused pipelines (base model + LCM-LoRA, in a given dtype), in cache_path/fused.
+
+    The first load fuses the LoRA as usual and saves the result as safetensors files. The next loads memory-map
+    the snapshot and skip the LoRA loading and fusion. A snapshot is only used if the content hashes of the source
+    weights (base model and LCM-LoRA, from the hugging face cache) match the ones it was made from.
+    The IP-Adapter is not fused (separate attention layers): it is loaded on top of the snapshot.
+    """
+    weight_extensions = ('.safetensors', '.bin')
+
+    def __init__(self, folder=path.join(cache_path, "fused")):
+        self.folder = folder
+        self.index_path = path.join(folder, "hashes.json")
+        self.hashes = None  # path --> (mtime, size, content hash), persisted in index_path
+
+    def snapshot_folder(self, model_id, dtype):
+        lcm_lora_id, _ = get_lcm_ids(model_id)
+        name = f"{model_id}_{lcm_lora_id}_{str(dtype).replace('torch.', '')}".replace('/', '--')
+        return path.join(self.folder, name)
+
+    def weights_hash(self, file_path):
+        """
+        Content hash of a weight file. Files of the hugging face cache are links to blobs named after their sha256,
+        other files are hashed once and the result is kept (until the file changes)
+        """
+        real_path = path.realpath(file_path)
+        if path.basename(path.dirname(real_path)) == "blobs":
+            return path.basename(real_path)
+
+        if self.hashes is None:
+            self.hashes = {}
+            if path.exists(self.index_path):
+                with open(self.index_path) as f:
+                    self.hashes = json.load(f)
+
+        stat = os.stat(real_path)
+        entry = self.hashes.get(real_path)
+        if entry is None or entry[:2] != [stat.st_mtime, stat.st_size]:
+            entry = [stat.st_mtime, stat.st_size, file_hash(real_path)]
+            self.hashes[real_path] = entry
+            os.makedirs(self.folder, exist_ok=True)
+            with open(self.index_path, 'w') as f:
+                json.dump(self.hashes, f)
+        return entry[2]
+
+    def fingerprint(self, model_id, dtype):
+        """
+        Returns a hash of the source weights, or None if they are not in the local cache
+        """
+        import diffusers
+        from huggingface_hub import snapshot_download
+
+        lcm_lora_id, _ = get_lcm_ids(model_id)
+        sources = []
+        for repo_id in (model_id, lcm_lora_id):
+            try:
+                folder = snapshot_download(repo_id, cache_dir=cache_path, local_files_only=True)
+            except Exception:
+                return None
+            for root, _, files in os.walk(folder):
+                for name in sorted(files):
+                    if name.endswith(self.weight_extensions):
+                        file_path = path.join(root, name)
+                        sources.append((repo_id, path.relpath(file_path, folder), self.weights_hash(file_path)))
+
+        if not sources:
+            return None
+        sources.sort()
+        key = json.dumps({'sources': sources, 'dtype': str(dtype), 'diffusers': diffusers.__version__})
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def load(self, model_id, dtype):
+        """
+        Returns the fused pipeline from its snapshot, or None if there is no valid snapshot
+        """
+        from diffusers import AutoPipelineForImage2Image
+
+        folder = self.snapshot_folder(model_id, dtype)
+        manifest_path = path.join(folder, "fused.json")
+        if not path.exists(manifest_path):
+            return None
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('fingerprint') != self.fingerprint(model_id, dtype):
+            print(f'fused snapshot of {model_id} is outdated')
+            return None
+
+        # safetensors files are memory-mapped, weights are only read when they are moved to the device
+        with timer(f"loading fused {model_id}"):
+            return AutoPipelineForImage2Image.from_pretrained(folder, torch_dtype=dtype, safety_checker=None)
+
+    def save(self, pipe, model_id, dtype):
+        """
+        Saves a fused pipeline. The LoRA layers must have been unloaded (their weights are in the base layers)
+        """
+        fingerprint = self.fingerprint(model_id, dtype)
+        if fingerprint is None:
+            return
+
+        folder = self.snapshot_folder(model_id, dtype)
+        tmp_folder = folder + ".tmp"
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        with timer(f"saving fused {model_id}"):
+            pipe.save_pretrained(tmp_folder, safe_serialization=True)
+        # the manifest is written last: an interrupted save is never used
+        with open(path.join(tmp_folder, "fused.json"), 'w') as f:
+            json.dump({'model_id': model_id, 'lcm_lora_id': get_lcm_ids(model_id)[0], 'dtype': str(dtype),
+                       'fingerprint': fingerprint}, f, indent=2)
+        shutil.rmtree(folder, ignore_errors=True)
+        os.replace(tmp_folder, folder)
+
+    def clear(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+        self.hashes = None
+
+
+fused_pipelines = FusedPipelineCache()
+
+
+def build_pipeline(model_id="runwayml/stable-diffusion-v1-5", use_ip=True, fused_cache=fused_pipelines, device=None):
+    """
+    Loads a base model, fuses the LCM-LoRA into it and optionally adds the IP-Adapter.
+    The pipeline stays on the CPU
+    :param fused_cache: FusedPipelineCache reused between loads and launches, None to always fuse the LoRA
+    :param device: device the pipeline will run on (gives the dtype), get_device() if None
+    """
+    from diffusers import AutoPipelineForImage2Image, LCMScheduler
+
+    if device is None:
+        device = get_device()
+    if device == "cuda":
+        torch.backends.cuda.matmul.allow_tf32 = True
+
+    dtype = get_dtype(device)
+    # the fp16 weights are smaller to download and load, also for bfloat16
+    use_fp16 = dtype != torch.float32
+
+    lcm_lora_id, ip_adapter_name = get_lcm_ids(model_id)
+
+    pipe = None
+    if fused_cache is not None:
+        pipe = fused_cache.load(model_id, dtype)
+
+    if pipe is None:
+        if use_fp16:
+            pipe = AutoPipelineForImage2Image.from_pretrained(
+                model_id,
+                cache_dir=cache_path,
+                torch_dtype=dtype,
+                variant="fp16",
+                safety_checker=None
+            )
+        else:
+            pipe = AutoPipelineForImage2Image.from_pretrained(
+                model_id,
+                cache_dir=cache_path,
+                safety_checker=None
+            )
+
+        pipe.load_lora_weights(lcm_lora_id)
+        pipe.fuse_lora()
+        if fused_cache is not None:
+            # the fused weights stay in the base layers
+            pipe.unload_lora_weights()
+            fused_cache.save(pipe, model_id, dtype)
+
+    pipe.scheduler = LCMScheduler.from_config(pipe.scheduler.config)
 
     # if using adapter
     if use_ip:
         pipe.load_ip_adapter("h94/IP-Adapter", subfolder="models", weight_name=ip_adapter_name)
-        ip_image = load_image(ip_ref_img)
+        set_ip_scale(pipe, 1.)
 
-    pipe.scheduler = LCMScheduler.from_config(pipe.scheduler.config)
-    pipe.load_lora_weights(lcm_lora_id)
-    pipe.fuse_lora()
+    return pipe
 
-    device = "mps" if is_mac else "cuda"
 
-    pipe.to(device=device)
+def set_ip_scale(pipe, scale):
+    """
+    Sets the IP-Adapter scale of a pipeline (like pipe.set_ip_adapter_scale). The scales are kept in tensors updated
+    in place: a compiled UNet reads them as inputs of its graph instead of constants, a new scale is not compiled
+    again. The tensors are shared by the pipelines built on the same UNet
+    """
+    for processor in pipe.unet.attn_processors.values():
+        if not hasattr(processor, 'to_k_ip'):
+            continue
+        scales = scale if isinstance(scale, list) else [scale] * len(processor.scale)
+        if not all(torch.is_tensor(s) for s in processor.scale):
+            with torch.inference_mode(False):
+                processor.scale = [torch.tensor(float(s)) for s in processor.scale]
+        with torch.no_grad():
+            for tensor, s in zip(processor.scale, scales):
+                tensor.fill_(float(s))
+
+
+class IPEmbedCache:
+    """
+    Caches the IP-Adapter image embeddings, so that the CLIP vision encoder runs once per reference image.
+
+    Embeddings are keyed by (content hash of the reference image, model family, adapter weights) and are also
+    persisted in cache_path/ip_embeds: switching between the built-in styles is instant, even after a restart.
+    Embeddings are stored with their negative (unconditional) half, as expected by diffusers when using CFG.
+    """
+    def __init__(self, folder=path.join(cache_path, "ip_embeds")):
+        self.folder = folder
+        self.embeds = {}
+        self.hashes = {}  # (path, mtime, size) --> content hash
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def get_hash(self, img_path):
+        stat = os.stat(img_path)
+        stamp = (img_path, stat.st_mtime, stat.st_size)
+        if stamp not in self.hashes:
+            self.hashes[stamp] = file_hash(img_path)
+        return self.hashes[stamp]
+
+    def make_key(self, img_path, model_id):
+        _, ip_adapter_name = get_lcm_ids(model_id)
+        return self.get_hash(img_path), get_model_family(model_id), ip_adapter_name
+
+    def get(self, pipe, img_path, model_id, device):
+        """
+        Returns the image embeddings for a reference image, computing them only if needed
+        :return: list of tensors (one per adapter), negative and positive embeddings concatenated
+        """
+        from diffusers.utils import load_image
+
+        key = self.make_key(img_path, model_id)
+        if key in self.embeds:
+            self.hits += 1
+            return self.embeds[key]
+        self.misses += 1
+
+        img_hash, family, ip_adapter_name = key
+        file_path = path.join(self.folder, f"{family}_{path.splitext(ip_adapter_name)[0]}_{img_hash}.pt")
+
+        if path.exists(file_path):
+            embeds = torch.load(file_path, map_location="cpu")
+            embeds = [e.to(device=device, dtype=pipe.image_encoder.dtype) for e in embeds]
+        else:
+            with timer("image embedding"):
+                embeds = pipe.prepare_ip_adapter_image_embeds(
+                    ip_adapter_image=load_image(img_path),
+                    ip_adapter_image_embeds=None,
+                    device=device,
+                    num_images_per_prompt=1,
+                    do_classifier_free_guidance=True
+                )
+            os.makedirs(self.folder, exist_ok=True)
+            torch.save([e.cpu() for e in embeds], file_path)
+
+        self.embeds[key] = embeds
+        return embeds
+
+    def clear(self):
+        # only the in-memory copies are released, the files stay on disk
+        self.embeds.clear()
+
+
+class PromptEmbedCache:
+    """
+    LRU cache of encoded prompts, keyed by (prompt, negative prompt, model id, clip skip).
+    During live capture the prompt rarely changes: the text encoder(s) only run when it does.
+    """
+    def __init__(self, max_size=32):
+        self.max_size = max_size
+        self.embeds = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def get(self, pipe, prompt, negative_prompt, model_id, device, clip_skip=None):
+        """
+        Returns the pipeline keyword arguments replacing prompt and negative_prompt
+        """
+        key = (prompt, negative_prompt, model_id, clip_skip)
+        if key in self.embeds:
+            self.hits += 1
+            self.embeds.move_to_end(key)
+            return self.embeds[key]
+
+        self.misses += 1
+        out = pipe.encode_prompt(
+            prompt=prompt,
+            device=device,
+            num_images_per_prompt=1,
+            do_classifier_free_guidance=True,
+            negative_prompt=negative_prompt,
+            clip_skip=clip_skip
+        )
+        embeds = {'prompt_embeds': out[0], 'negative_prompt_embeds': out[1]}
+        # SDXL also returns pooled embeddings
+        if len(out) == 4:
+            embeds['pooled_prompt_embeds'] = out[2]
+            embeds['negative_pooled_prompt_embeds'] = out[3]
+
+        self.embeds[key] = embeds
+        if len(self.embeds) > self.max_size:
+            self.embeds.popitem(last=False)
+
+        print(f'prompt encoded (cache hit rate: {self.hit_rate:.0%})')
+        return embeds
+
+    def clear(self):
+        self.embeds.clear()
+
+
+# tiny autoencoders, shared by all pipelines of the same family
+tiny_vaes = {}
+
+
+def get_tiny_vae(model_id, device, dtype=None, random_weights=False):
+    """
+    Returns a tiny distilled autoencoder (TAESD) matching a base model, for fast previews.
+    :param random_weights: (bool) randomly initialised weights (tests and benchmarks without download)
+    """
+    from diffusers import AutoencoderTiny
+
+    if dtype is None:
+        dtype = torch.float32
+    family = get_model_family(model_id)
+    key = (family, str(device), dtype, random_weights)
+    if key not in tiny_vaes:
+        if random_weights:
+            vae = AutoencoderTiny()
+        else:
+            taesd_id = "madebyollin/taesdxl" if family == "sdxl" else "madebyollin/taesd"
+            vae = AutoencoderTiny.from_pretrained(taesd_id, cache_dir=cache_path, torch_dtype=dtype)
+        tiny_vaes[key] = vae.to(device=device, dtype=dtype)
+    return tiny_vaes[key]
+
+
+@contextmanager
+def use_vae(pipe, vae):
+    """
+    Temporarily replaces the VAE of a pipeline (None keeps the current one)
+    """
+    if vae is None or vae is pipe.vae:
+        yield
+        return
+
+    full_vae = pipe.vae
+    pipe.vae = vae
+    try:
+        yield
+    finally:
+        pipe.vae = full_vae
+
+
+@contextmanager
+def use_unet(pipe, unet):
+    """
+    Temporarily replaces the UNet of a pipeline (None keeps the current one)
+    """
+    if unet is None or unet is pipe.unet:
+        yield
+        return
+
+    eager_unet = pipe.unet
+    pipe.unet = unet
+    try:
+        yield
+    finally:
+        pipe.unet = eager_unet
+
+
+def tiled_vae(vae):
+    """
+    Returns a VAE encoding and decoding in overlapping tiles (blended seams), for large images. It is a shallow copy
+    sharing the weights: the VAE itself is not modified, so other pipelines using it (e.g. compile warm-ups running
+    in the background) are not affected
+    """
+    if not hasattr(vae, 'enable_tiling') or vae.use_tiling:
+        return vae
+    tiled = copy.copy(vae)
+    tiled.enable_tiling()
+    return tiled
+
+
+class CompileBuckets:
+    """
+    Compiled execution of the UNet (torch.compile) on a fixed set of resolution buckets.
+
+    Inputs are padded to the smallest bucket containing them and the outputs are cropped back, so that the compiled
+    UNet only sees a few shapes. A shape (model, bucket, batch) only runs compiled once it has been warmed up in the
+    background (see PipelineManager.warm_up_bucket): until then the eager UNet is used, and a size change never
+    stalls on a compilation. Compiled kernels are kept in cache_path/inductor and the warmed up shapes are listed in
+    cache_path/compiled/buckets.json, to be warmed up again (from the cache) at the next launch.
+    The IP-Adapter scale is an input of the compiled graph (see set_ip_scale), it is not part of the shape.
+    """
+    sides = (384, 512, 768, 1024)
+
+    def __init__(self, folder=path.join(cache_path, "compiled")):
+        self.folder = folder
+        self.index_path = path.join(folder, "buckets.json")
+        self.compiled = {}  # id(eager UNet) --> (eager UNet, compiled UNet)
+        self.warm = set()
+        self.lock = threading.Lock()
+
+    def snap(self, size):
+        """
+        Returns the smallest bucket containing an image size, or None if the image is larger than all the buckets
+        """
+        w, h = size
+        fits = [(bw, bh) for bw in self.sides for bh in self.sides if bw >= w and bh >= h]
+        if not fits:
+            return None
+        return min(fits, key=lambda b: (b[0] * b[1], b))
+
+    @staticmethod
+    def pad(image, bucket):
+        """
+        Pads an image to a bucket size (bottom and right), repeating the border pixels
+        """
+        import numpy as np
+        from PIL import Image
+
+        arr = np.asarray(image.convert('RGB'))
+        h, w = arr.shape[:2]
+        arr = np.pad(arr, ((0, bucket[1] - h), (0, bucket[0] - w), (0, 0)), mode='edge')
+        return Image.fromarray(arr)
+
+    def get_unet(self, pipe):
+        """
+        Returns the compiled version of the UNet of a pipeline. Each new shape is compiled on its first call
+        """
+        if hasattr(pipe.unet, '_orig_mod'):
+            # already compiled (CPU backend with FOCUSPOCUS_COMPILE)
+            return pipe.unet
+        with self.lock:
+            key = id(pipe.unet)
+            if key not in self.compiled:
+                os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", path.join(cache_path, "inductor"))
+                import torch._dynamo
+                import torch._inductor.config
+                # compiled graphs are reused across launches
+                torch._inductor.config.fx_graph_cache = True
+                torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit,
+                                                            4 * len(self.sides) ** 2)
+                self.compiled[key] = (pipe.unet, torch.compile(pipe.unet))
+            return self.compiled[key][1]
+
+    @staticmethod
+    def make_key(model_id, use_ip, bucket, num_variants=1, guidance_scale=1):
+        # classifier free guidance doubles the UNet batch
+        return model_id, use_ip, tuple(bucket), num_variants, guidance_scale > 1
 
+    def is_warm(self, key):
+        with self.lock:
+            return key in self.warm
+
+    def mark_warm(self, key):
+        with self.lock:
+            self.warm.add(key)
+            keys = self._load_index()
+            if list(key) not in keys:
+                keys.append(list(key))
+                os.makedirs(self.folder, exist_ok=True)
+                with open(self.index_path, 'w') as f:
+                    json.dump(keys, f)
+
+    def known(self, model_id, use_ip):
+        """
+        Shapes of a model warmed up during the previous sessions
+        """
+        with self.lock:
+            keys = [(k[0], k[1], tuple(k[2]), k[3], k[4]) for k in self._load_index()]
+        return [k for k in keys if k[:2] == (model_id, use_ip)]
+
+    def _load_index(self):
+        if not path.exists(self.index_path):
+            return []
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def release(self, pipe):
+        with self.lock:
+            self.compiled.pop(id(pipe.unet), None)
+
+
+class StreamBatchDenoiser:
+    """
+    StreamDiffusion-style pipelined denoising of consecutive frames (SD 1.5 family, no classifier free guidance).
+
+    Instead of running all the steps of a frame before starting the next one, a rolling batch holds frames at
+    different denoising steps: each UNet forward pass advances every frame in flight by one step, and one finished
+    frame comes out per pass. With k steps, outputs are delayed by k - 1 frames but the throughput is close to one
+    frame per UNet pass. The LCM scheduler of the pipeline gives the timesteps and the boundary conditions.
+    """
+    def __init__(self, pipe, device):
+        self.pipe = pipe
+        self.device = device
+        self.config = None
+        self.latents = []  # frames in flight, index j waits for the denoising step j + 1
+
+    def reset(self):
+        self.latents = []
+
+    @property
+    def n_in_flight(self):
+        return len(self.latents)
+
+    def prepare(self, num_inference_steps, strength, prompt_embeds, image_embeds, size, seed):
+        self.image_embeds = image_embeds
+
+        config = (num_inference_steps, strength, id(prompt_embeds), size, seed, id(self.pipe.vae))
+        if config == self.config:
+            return
+        self.config = config
+        self.reset()
+        self.prompt_embeds = prompt_embeds
+
+        scheduler = self.pipe.scheduler
+        scheduler.set_timesteps(num_inference_steps, device=self.device)
+        # same strength handling as the img2img pipeline
+        init_timestep = max(1, min(int(num_inference_steps * strength), num_inference_steps))
+        self.timesteps = scheduler.timesteps[num_inference_steps - init_timestep:]
+        k = len(self.timesteps)
+
+        alphas_cumprod = scheduler.alphas_cumprod.to(self.device)
+        self.alphas = alphas_cumprod[self.timesteps].view(-1, 1, 1, 1)
+        scalings = [scheduler.get_scalings_for_boundary_condition_discrete(t) for t in self.timesteps]
+        self.c_skip = torch.tensor([float(c[0]) for c in scalings], device=self.device).view(-1, 1, 1, 1)
+        self.c_out = torch.tensor([float(c[1]) for c in scalings], device=self.device).view(-1, 1, 1, 1)
+
+        # fixed noise per step: consecutive frames stay temporally consistent
+        dtype = self.pipe.unet.dtype
+        w, h = size
+        shape = (k, self.pipe.unet.config.in_channels, h // self.pipe.vae_scale_factor, w // self.pipe.vae_scale_factor)
+        generator = torch.Generator().manual_seed(seed)
+        self.noise = torch.randn(shape, generator=generator).to(device=self.device, dtype=dtype)
+
+    def push(self, image):
+        """
+        Adds a frame to the stream and advances all frames in flight by one step.
+        :param image: (PIL.Image) input frame
+        :return: (PIL.Image) the oldest frame, if it is finished, else None
+        """
+        from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_img2img import retrieve_latents
+
+        pipe = self.pipe
+        vae = pipe.vae
+        k = len(self.timesteps)
+
+        # encode the new frame and noise it to the first timestep
+        x = pipe.image_processor.preprocess(image).to(device=self.device, dtype=vae.dtype)
+        x0 = retrieve_latents(vae.encode(x), sample_mode="argmax") * vae.config.scaling_factor
+        x0 = x0.to(self.noise.dtype)
+        a0 = self.alphas[0]
+        x_t = a0.sqrt() * x0 + (1 - a0).sqrt() * self.noise[0:1]
+
+        batch = torch.cat([x_t] + self.latents)
+        n = batch.shape[0]
+
+        added_cond_kwargs = None
+        if self.image_embeds is not None:
+            added_cond_kwargs = {'image_embeds': [e.repeat(n, *[1] * (e.dim() - 1)) for e in self.image_embeds]}
+
+        # one UNet pass for all the frames in flight, each at its own timestep
+        eps = pipe.unet(
+            batch,
+            self.timesteps[:n],
+            encoder_hidden_states=self.prompt_embeds.repeat(n, 1, 1),
+            added_cond_kwargs=added_cond_kwargs,
+            return_dict=False
+        )[0]
+
+        a = self.alphas[:n]
+        pred_x0 = (batch - (1 - a).sqrt() * eps) / a.sqrt()
+        denoised = self.c_out[:n] * pred_x0 + self.c_skip[:n] * batch
+
+        out = None
+        latents = []
+        for j in range(n):
+            if j == k - 1:
+                out = denoised[j:j + 1]
+            else:
+                # noise to the next timestep
+                a_next = self.alphas[j + 1]
+                latents.append(a_next.sqrt() * denoised[j:j + 1] + (1 - a_next).sqrt() * self.noise[j + 1:j + 2])
+        self.latents = latents
+
+        if out is None:
+            return None
+
+        decoded = vae.decode(out.to(vae.dtype) / vae.config.scaling_factor, return_dict=False)[0]
+        return pipe.image_processor.postprocess(decoded, output_type="pil")[0]
+
+
+class TiledDenoiser:
+    """
+    MultiDiffusion-style img2img for large images (SD 1.5 family), with a peak memory independent of the image size.
+
+    The latents are split into overlapping tiles. At each step, the UNet runs on batches of tiles and the noise
+    predictions are blended with weights decreasing towards the tile borders, then the scheduler steps on the whole
+    latent image: the tiles stay consistent and there are no visible seams. The VAE encodes and decodes in tiles too.
+    """
+    def __init__(self, pipe, device, tile_size=512, overlap=128, batch_size=4):
+        """
+        :param tile_size: (int) tile side, in pixels
+        :param overlap: (int) overlap between neighbouring tiles, in pixels
+        :param batch_size: (int) number of tiles per UNet call
+        """
+        self.pipe = pipe
+        self.device = device
+        self.tile = tile_size // pipe.vae_scale_factor
+        self.overlap = overlap // pipe.vae_scale_factor
+        self.batch_size = batch_size
+
+    @staticmethod
+    def tile_starts(length, tile, stride):
+        if length <= tile:
+            return [0]
+        return list(range(0, length - tile, stride)) + [length - tile]
+
+    def tile_weights(self, h, w, like):
+        """
+        (1, 1, h, w) blending weights: 1 in the tile, decreasing linearly in the overlap towards the borders
+        """
+        def ramp(n):
+            idx = torch.arange(n, device=like.device, dtype=torch.float32)
+            return torch.clamp(torch.minimum(idx + 1, n - idx) / (self.overlap + 1), max=1.)
+
+        return (ramp(h)[:, None] * ramp(w)[None, :]).to(like.dtype)[None, None]
+
+    @staticmethod
+    def repeat_embeds(e, n, cfg):
+        # with guidance, the embeddings are (negative, positive): each half is repeated for the n tiles
+        if cfg:
+            return torch.cat([half.repeat(n, *[1] * (e.dim() - 1)) for half in e.chunk(2)])
+        return e.repeat(n, *[1] * (e.dim() - 1))
+
+    def predict_noise(self, latents, t, prompt_embeds, negative_prompt_embeds, image_embeds, guidance_scale):
+        _, _, h, w = latents.shape
+        th, tw = min(self.tile, h), min(self.tile, w)
+        tiles = [(y, x) for y in self.tile_starts(h, th, th - self.overlap)
+                 for x in self.tile_starts(w, tw, tw - self.overlap)]
+        weight = self.tile_weights(th, tw, latents)
+        cfg = negative_prompt_embeds is not None
+
+        noise_sum = torch.zeros_like(latents)
+        weight_sum = torch.zeros_like(latents[:, :1])
+        for i in range(0, len(tiles), self.batch_size):
+            batch_tiles = tiles[i:i + self.batch_size]
+            n = len(batch_tiles)
+            sample = torch.cat([latents[:, :, y:y + th, x:x + tw] for y, x in batch_tiles])
+            embeds = prompt_embeds.repeat(n, 1, 1)
+            if cfg:
+                sample = torch.cat([sample, sample])
+                embeds = torch.cat([negative_prompt_embeds.repeat(n, 1, 1), embeds])
+
+            added_cond_kwargs = None
+            if image_embeds is not None:
+                added_cond_kwargs = {'image_embeds': [self.repeat_embeds(e, n, cfg) for e in image_embeds]}
+
+            out = self.pipe.unet(sample, t, encoder_hidden_states=embeds, added_cond_kwargs=added_cond_kwargs,
+                                 return_dict=False)[0]
+            if cfg:
+                negative, positive = out.chunk(2)
+                out = negative + guidance_scale * (positive - negative)
+
+            for j, (y, x) in enumerate(batch_tiles):
+                noise_sum[:, :, y:y + th, x:x + tw] += out[j:j + 1] * weight
+                weight_sum[:, :, y:y + th, x:x + tw] += weight
+
+        return noise_sum / weight_sum
+
+    def __call__(self, image, num_inference_steps, strength, guidance_scale, seed, prompt_embeds,
+                 negative_prompt_embeds=None, image_embeds=None):
+        """
+        :param image: (PIL.Image) input image, any size (multiple of 8)
+        :param negative_prompt_embeds: only used with guidance (guidance_scale > 1)
+        :param image_embeds: IP-Adapter embeddings (with the negative half when using guidance)
+        :return: (PIL.Image)
+        """
+        from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_img2img import retrieve_latents
+
+        pipe = self.pipe
+        vae = tiled_vae(pipe.vae)
+        scheduler = pipe.scheduler
+        generator = torch.Generator().manual_seed(seed)
+        if guidance_scale <= 1:
+            negative_prompt_embeds = None
+
+        # same strength handling as the img2img pipeline
+        scheduler.set_timesteps(num_inference_steps, device=self.device)
+        init_timestep = max(1, min(int(num_inference_steps * strength), num_inference_steps))
+        t_start = num_inference_steps - init_timestep
+        timesteps = scheduler.timesteps[t_start:]
+        if hasattr(scheduler, 'set_begin_index'):
+            scheduler.set_begin_index(t_start)
+
+        x = pipe.image_processor.preprocess(image).to(device=self.device, dtype=vae.dtype)
+        x0 = retrieve_latents(vae.encode(x), generator=generator) * vae.config.scaling_factor
+        x0 = x0.to(pipe.unet.dtype)
+        noise = torch.randn(x0.shape, generator=generator).to(device=self.device, dtype=x0.dtype)
+        latents = scheduler.add_noise(x0, noise, timesteps[:1])
+
+        for t in timesteps:
+            noise_pred = self.predict_noise(latents, t, prompt_embeds, negative_prompt_embeds, image_embeds,
+                                            guidance_scale)
+            latents = scheduler.step(noise_pred, t, latents, generator=generator, return_dict=False)[0]
+
+        decoded = vae.decode(latents.to(vae.dtype) / vae.config.scaling_factor, return_dict=False)[0]
+        return pipe.image_processor.postprocess(decoded, output_type="pil")[0]
+
+
+def make_infer(pipe, model_id, use_ip=True, ip_ref_img=res.find('img/ref1.png'), lock=None, ip_cache=None,
+               prompt_cache=None, device=None, tiny_vae=None, buckets=None, on_cold=None):
+    """
+    Creates the inference function for a loaded pipeline.
+    :param lock: optional lock held during inference, so that the pipeline cannot be moved while it is used
+    :param ip_cache: optional IPEmbedCache, shared between pipelines
+    :param prompt_cache: optional PromptEmbedCache
+    :param device: device of the pipeline, get_device() if None
+    :param tiny_vae: autoencoder used when fast_vae is True. If None, TAESD is loaded on first use
+    :param buckets: optional CompileBuckets, for the compiled execution mode
+    :param on_cold: function(key) called (from the inference thread) when a bucket shape is not warmed up yet
+    """
+    from diffusers.utils import load_image
+    from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_img2img import retrieve_latents
+
+    if device is None:
+        device = get_device()
     generator = torch.Generator()
+    if lock is None:
+        lock = nullcontext()
+    if ip_cache is None:
+        ip_cache = IPEmbedCache()
+    if prompt_cache is None:
+        prompt_cache = PromptEmbedCache()
+    streamer = None
+    tiler = None
+
+    def is_streamed(stream, num_variants, guidance_scale):
+        return stream and num_variants == 1 and guidance_scale <= 1 and get_model_family(model_id) == "sd15"
 
     def infer(
             prompt,
@@ -124,33 +1081,505 @@ def load_models(model_id="runwayml/stable-diffusion-v1-5", use_ip=True, ip_ref_i
             guidance_scale=1,
             strength=0.9,
             seed=random.randrange(0, 2**63),
-            ip_scale=1
+            ip_scale=1,
+            ip_ref_img=ip_ref_img,
+            clip_skip=None,
+            num_variants=1,
+            seeds=None,
+            strengths=None,
+            fast_vae=False,
+            stream=False,
+            tiled=False
     ):
-        print(image)
-        with torch.inference_mode():
-            with torch.autocast("cuda") if device == "cuda" else nullcontext():
-                with timer("inference"):
-                    if use_ip:
-                        pipe.set_ip_adapter_scale(ip_scale)
+        """
+        Returns the generated image, or a list of images when num_variants > 1.
+        Variants are generated in one batched call: the input image is VAE-encoded once and the prompt embeddings
+        are shared. Each variant uses its own seed (seeds, or seed, seed + 1, ...) and optionally its own strength.
+        Variants with different strengths cannot share the denoising schedule: they are batched per strength value.
+        With fast_vae, the image is encoded and decoded by a tiny autoencoder (live preview quality).
+        With stream, consecutive frames are denoised in a rolling batch (see StreamBatchDenoiser): None is returned
+        while the first frames are still in flight. Only for SD 1.5 models without guidance, else ignored.
+        With tiled, large images are denoised in overlapping tiles (see TiledDenoiser), with a bounded memory. For
+        SDXL models, only the VAE is tiled.
+        """
+        # images are passed in memory, paths are still accepted
+        if isinstance(image, str):
+            image = load_image(image)
+
+        # compiled mode: the image is padded to its bucket, the output is cropped back to the input size
+        size = image.size
+        bucket = buckets.snap(size) if buckets is not None else None
+        unet = None
+        if bucket is not None:
+            if bucket != size:
+                image = buckets.pad(image, bucket)
+            # the stream batch changes size at each frame and tiles have their own shape: only full denoising of the
+            # whole image runs compiled
+            if not (tiled or is_streamed(stream, num_variants, guidance_scale)):
+                key = buckets.make_key(model_id, use_ip, bucket, num_variants, guidance_scale)
+                if buckets.is_warm(key):
+                    unet = buckets.get_unet(pipe)
+                elif on_cold is not None:
+                    on_cold(key)
+
+        out = run(prompt, negative_prompt, image, num_inference_steps, guidance_scale, strength, seed, ip_scale,
+                  ip_ref_img, clip_skip, num_variants, seeds, strengths, fast_vae, stream, tiled, unet)
+
+        if bucket is None or bucket == size or out is None:
+            return out
+        if isinstance(out, list):
+            return [im.crop((0, 0) + size) for im in out]
+        return out.crop((0, 0) + size)
+
+    def run(prompt, negative_prompt, image, num_inference_steps, guidance_scale, strength, seed, ip_scale,
+            ip_ref_img, clip_skip, num_variants, seeds, strengths, fast_vae, stream, tiled, unet):
+        nonlocal tiny_vae, streamer, tiler
+
+        with lock, torch.inference_mode():
+            if pipe.device.type != torch.device(device).type:
+                # the pipeline was moved out of the device by the pipeline manager in the meantime
+                raise RuntimeError("pipeline is not loaded on the device anymore")
+
+            # changing the reference image only swaps the (cached) image embeddings, the pipeline is untouched
+            extra_args = {}
+            if use_ip:
+                embeds = ip_cache.get(pipe, ip_ref_img, model_id, device)
+                if guidance_scale <= 1:
+                    # no classifier free guidance: only keep the positive half
+                    embeds = [e.chunk(2)[1] for e in embeds]
+                extra_args['ip_adapter_image_embeds'] = embeds
+
+            vae = None
+            if fast_vae:
+                if tiny_vae is None:
+                    tiny_vae = get_tiny_vae(model_id, device, dtype=pipe.vae.dtype)
+                vae = tiny_vae
+            if tiled:
+                # the VAE is shared with the background warm-ups: tiling is enabled on a copy
+                vae = tiled_vae(vae if vae is not None else pipe.vae)
+
+            with autocast(device, pipe.unet.dtype), use_vae(pipe, vae), use_unet(pipe, unet):
+                with timer("inference", quiet=True):
+                    # ip_scale None keeps the current scale (background warm-ups)
+                    if use_ip and ip_scale is not None:
+                        set_ip_scale(pipe, ip_scale)
+                    # prompt embeddings are reused from one frame to the other
+                    prompt_args = prompt_cache.get(pipe, prompt, negative_prompt, model_id, device,
+                                                   clip_skip=clip_skip)
+
+                    if is_streamed(stream, num_variants, guidance_scale):
+                        if streamer is None:
+                            streamer = StreamBatchDenoiser(pipe, device)
+                        streamer.prepare(num_inference_steps, strength, prompt_args['prompt_embeds'],
+                                         extra_args.get('ip_adapter_image_embeds'), image.size, seed)
+                        return streamer.push(image)
+                    if streamer is not None:
+                        # the stream was interrupted (e.g. the canvas drives the inference again): the frames still in
+                        # flight are stale
+                        streamer.reset()
+
+                    if tiled and num_variants == 1 and get_model_family(model_id) == "sd15":
+                        if tiler is None:
+                            tiler = TiledDenoiser(pipe, device)
+                        return tiler(image, num_inference_steps, strength, guidance_scale, seed,
+                                     prompt_args['prompt_embeds'], prompt_args['negative_prompt_embeds'],
+                                     extra_args.get('ip_adapter_image_embeds'))
+
+                    if num_variants == 1:
                         return pipe(
-                            prompt=prompt,
-                            negative_prompt=negative_prompt,
-                            image=load_image(image),
-                            ip_adapter_image=ip_image,
+                            image=image,
                             generator=generator.manual_seed(seed),
                             num_inference_steps=num_inference_steps,
                             guidance_scale=guidance_scale,
-                            strength=strength
+                            strength=strength,
+                            **prompt_args,
+                            **extra_args
                         ).images[0]
-                    else:
-                        return pipe(
-                            prompt=prompt,
-                            negative_prompt=negative_prompt,
-                            image=load_image(image),
-                            generator=generator.manual_seed(seed),
+
+                    if seeds is None:
+                        seeds = [seed + i for i in range(num_variants)]
+                    if strengths is None:
+                        strengths = [strength] * num_variants
+
+                    # group the variants by strength, one batched call per group
+                    groups = OrderedDict()
+                    for i, s in enumerate(strengths[:num_variants]):
+                        groups.setdefault(s, []).append(i)
+
+                    # the image is encoded once: the pipelines take the latents in place of the image, and each
+                    # variant only adds its own noise
+                    x = pipe.image_processor.preprocess(image).to(device=device, dtype=pipe.vae.dtype)
+                    latents = retrieve_latents(pipe.vae.encode(x), sample_mode="argmax")
+                    latents = latents * pipe.vae.config.scaling_factor
+
+                    images = [None] * num_variants
+                    for s, indices in groups.items():
+                        batch = pipe(
+                            image=latents.repeat(len(indices), 1, 1, 1),
+                            num_images_per_prompt=len(indices),
+                            generator=[torch.Generator().manual_seed(seeds[i]) for i in indices],
                             num_inference_steps=num_inference_steps,
                             guidance_scale=guidance_scale,
-                            strength=strength
-                        ).images[0]
+                            strength=s,
+                            **prompt_args,
+                            **extra_args
+                        ).images
+                        for i, im in zip(indices, batch):
+                            images[i] = im
+
+                    return images
+
+    return infer
+
+
+def load_models(model_id="runwayml/stable-diffusion-v1-5", use_ip=True, ip_ref_img=res.find('img/ref1.png'),
+                device=None):
+    if device is None:
+        device = get_device()
+    pipe = build_pipeline(model_id=model_id, use_ip=use_ip, device=device)
+    pipe.to(device=device)
+    if device == "cpu":
+        configure_cpu(cpu_threads)
+        tune_for_cpu(pipe, compile_unet=cpu_compile)
+
+    return make_infer(pipe, model_id, use_ip=use_ip, ip_ref_img=ip_ref_img, device=device)
+
+
+def warm_up(infer, size=(512, 512), prompt='', **kwargs):
+    """
+    Runs a first inference on a blank image, which is discarded. Kernel selection, memory allocations and the
+    embedding caches are done here instead of on the first frame of the user.
+    :param kwargs: other infer arguments (e.g. ip_ref_img, to cache its embeddings)
+    """
+    from PIL import Image
+
+    with timer("warm-up"):
+        # 2 steps at strength 0.5 --> a single denoising step
+        infer(prompt=prompt, negative_prompt='', image=Image.new('RGB', size, 'white'), num_inference_steps=2,
+              strength=0.5, **kwargs)
+
+
+def build_tiny_pipeline(seed=0):
+    """
+    Builds a tiny img2img pipeline with random weights (SD 1.5 architecture, a few MB), running on the CPU.
+    Used for benchmarks and tests: the outputs are meaningless, but every stage of the real pipeline is executed.
+    """
+    import tempfile
+    from diffusers import AutoencoderKL, LCMScheduler, StableDiffusionImg2ImgPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    torch.manual_seed(seed)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=2,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32,
+    )
+    # 4 blocks: same downscaling factor (8) as the real VAE
+    vae = AutoencoderKL(
+        block_out_channels=[32, 32, 64, 64],
+        in_channels=3,
+        out_channels=3,
+        down_block_types=["DownEncoderBlock2D"] * 4,
+        up_block_types=["UpDecoderBlock2D"] * 4,
+        latent_channels=4,
+        norm_num_groups=16,
+    )
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        bos_token_id=0,
+        eos_token_id=1,
+        pad_token_id=1,
+        hidden_size=32,
+        intermediate_size=37,
+        layer_norm_eps=1e-05,
+        num_attention_heads=4,
+        num_hidden_layers=5,
+        vocab_size=1000,
+    ))
+
+    # byte-level vocabulary without merges, so that no file has to be downloaded
+    chars = list(bytes_to_unicode().values())
+    vocab = ["<|startoftext|>", "<|endoftext|>"] + chars + [c + "</w>" for c in chars]
+    with tempfile.TemporaryDirectory() as tmp:
+        vocab_file = path.join(tmp, "vocab.json")
+        merges_file = path.join(tmp, "merges.txt")
+        with open(vocab_file, "w", encoding="utf-8") as f:
+            json.dump({token: i for i, token in enumerate(vocab)}, f)
+        with open(merges_file, "w", encoding="utf-8") as f:
+            f.write("#version: 0.2\n")
+        tokenizer = CLIPTokenizer(vocab_file, merges_file, model_max_length=77)
+
+    return StableDiffusionImg2ImgPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        scheduler=LCMScheduler(),
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+
+
+def load_stub_models(delay=0.):
+    """
+    Returns an inference function with the same signature as the one from load_models, without any model.
+    The output is a simple color transform of the input, computed on the CPU. Useful to test the application
+    (threads, I/O, throughput) without a GPU.
+    :param delay: (float) simulated time per denoising step, in seconds
+    """
+    import numpy as np
+    from PIL import Image
+
+    def run(image, strength, seed):
+        rng = np.random.default_rng(seed)
+        tint = rng.uniform(0, 255, size=3).astype(np.float32)
+        arr = np.asarray(image.convert('RGB'), dtype=np.float32)
+        arr = (1 - strength) * arr + strength * (0.5 * arr + 0.5 * tint)
+        return Image.fromarray(arr.clip(0, 255).astype(np.uint8))
+
+    def infer(
+            prompt,
+            negative_prompt,
+            image,
+            num_inference_steps=4,
+            guidance_scale=1,
+            strength=0.9,
+            seed=random.randrange(0, 2**63),
+            ip_scale=1,
+            ip_ref_img=None,
+            clip_skip=None,
+            num_variants=1,
+            seeds=None,
+            strengths=None,
+            **kwargs
+    ):
+        # other options (fast_vae, ...) have no effect on the stub
+        if isinstance(image, str):
+            image = Image.open(image)
+
+        with timer("inference", quiet=True):
+            time.sleep(delay * num_inference_steps)
+            if num_variants == 1:
+                return run(image, strength, seed)
+
+            if seeds is None:
+                seeds = [seed + i for i in range(num_variants)]
+            if strengths is None:
+                strengths = [strength] * num_variants
+            return [run(image, s, sd) for s, sd in zip(strengths, seeds)]
+
+    return infer
+
+
+class PipelineManager:
+    """
+    Keeps a bounded LRU of loaded pipelines, keyed by (model_id, use_ip, lcm_lora_id).
+
+    When the pipelines on the device exceed the memory budget (or max_on_device), the least recently used ones are
+    first moved to the CPU. Pipelines beyond max_loaded are discarded.
+    """
+    def __init__(self, max_loaded=3, max_on_device=1, device_budget=None):
+        """
+        :param max_loaded: (int) maximum number of pipelines kept in memory (device + CPU)
+        :param max_on_device: (int) maximum number of pipelines kept on the device
+        :param device_budget: (int) memory budget for pipelines on the device, in bytes. If None, 80% of the GPU memory
+        """
+        self.max_loaded = max_loaded
+        self.max_on_device = max_on_device
+        self._device = None  # resolved on first use (torch is only imported then)
+        self.device_budget = device_budget  # default set on the first load (torch is only imported then)
+
+        self.pipes = OrderedDict()  # key --> pipeline, the most recently used last
+        self.sizes = {}
+        self.on_device = set()
+        self.lock = threading.RLock()
+        # pipelines used outside of the lock (compile warm-ups) cannot be moved or discarded
+        self.pins = Counter()
+        self.unpinned = threading.Condition(self.lock)
+        self.ip_cache = IPEmbedCache()
+        self.prompt_cache = PromptEmbedCache()
+
+        # compiled execution mode, see CompileBuckets
+        self.compiled = False
+        self.buckets = CompileBuckets()
+        self.on_cold = None  # function(key) called when a bucket shape needs a warm-up
+
+    @property
+    def device(self):
+        if self._device is None:
+            self._device = get_device()
+            if self._device == "cpu":
+                configure_cpu(cpu_threads)
+        return self._device
+
+    def make_key(self, model_id, use_ip):
+        lcm_lora_id, _ = get_lcm_ids(model_id)
+        return model_id, use_ip, lcm_lora_id
+
+    def get(self, model_id, use_ip):
+        """
+        Returns a pipeline on the device, loading it only if it is not already cached
+        """
+        key = self.make_key(model_id, use_ip)
+        with self.lock:
+            if self.device_budget is None and self.device == "cuda" and torch.cuda.is_available():
+                self.device_budget = int(0.8 * torch.cuda.get_device_properties(0).total_memory)
+
+            if key in self.pipes:
+                self.pipes.move_to_end(key)
+            else:
+                with timer(f"loading {model_id}"):
+                    pipe = build_pipeline(model_id=model_id, use_ip=use_ip, device=self.device)
+                    if self.device == "cpu":
+                        tune_for_cpu(pipe, compile_unet=cpu_compile)
+                self.pipes[key] = pipe
+                self.sizes[key] = pipeline_size(pipe)
+
+            # make room on the device before moving the new pipeline
+            self._evict(keep=key)
+
+            if key not in self.on_device:
+                self.pipes[key].to(device=self.device)
+                self.on_device.add(key)
+
+            return self.pipes[key]
+
+    def is_loaded(self, model_id, use_ip):
+        with self.lock:
+            return self.make_key(model_id, use_ip) in self.pipes
+
+    def get_infer(self, model_id, use_ip, ip_ref_img=res.find('img/ref1.png')):
+        pipe = self.get(model_id, use_ip)
+        return make_infer(pipe, model_id, use_ip=use_ip, ip_ref_img=ip_ref_img, lock=self.lock,
+                          ip_cache=self.ip_cache, prompt_cache=self.prompt_cache, device=self.device,
+                          buckets=self.buckets if self.compiled else None, on_cold=self.on_cold)
+
+    def warm_up_bucket(self, key, **kwargs):
+        """
+        Compiles the UNet for a bucket shape, without blocking the live inference: the warm-up runs on a twin
+        pipeline sharing the weights, with the compiled UNet and its own scheduler. Once done, the shape runs
+        compiled in the inference functions of this manager.
+        :param key: bucket shape, see CompileBuckets.make_key
+        :param kwargs: other infer arguments (prompt, ip_ref_img...)
+        """
+        from diffusers import LCMScheduler
+        from PIL import Image
+
+        model_id, use_ip, bucket, num_variants, cfg = key
+        if self.buckets.is_warm(key):
+            return
+        pipe_key = self.make_key(model_id, use_ip)
+        with self.lock:
+            pipe = self.pipes.get(pipe_key)
+            if pipe is None or pipe_key not in self.on_device:
+                return
+            components = dict(pipe.components, unet=self.buckets.get_unet(pipe),
+                              scheduler=LCMScheduler.from_config(pipe.scheduler.config))
+            twin = type(pipe)(**components)
+            # the weights stay on the device until the warm-up is done
+            self.pins[pipe_key] += 1
+
+        try:
+            # separate caches: they are not shared between threads
+            infer = make_infer(twin, model_id, use_ip=use_ip, device=self.device, ip_cache=IPEmbedCache(),
+                               prompt_cache=PromptEmbedCache())
+            kwargs.setdefault('prompt', '')
+            with timer(f"compiling {bucket[0]}x{bucket[1]} (batch {num_variants}{', cfg' if cfg else ''})"):
+                infer(image=Image.new('RGB', bucket, 'white'), negative_prompt='', num_inference_steps=2,
+                      strength=0.5, guidance_scale=2 if cfg else 1, num_variants=num_variants, ip_scale=None,
+                      **kwargs)
+        finally:
+            with self.lock:
+                self.pins[pipe_key] -= 1
+                if self.pins[pipe_key] <= 0:
+                    del self.pins[pipe_key]
+                self.unpinned.notify_all()
+        self.buckets.mark_warm(key)
+
+    def text_to_image(self, prompt, model_id, use_ip, ip_ref_img=res.find('img/ref1.png'), seed=None):
+        """
+        Generates an image from a prompt with the components of the cached pipeline (e.g. style pre-images).
+        Only one inference: the model is not loaded again if it is already cached
+        """
+        import sd_maker
+
+        with self.lock:
+            pipe = self.get(model_id, use_ip)
+
+        with self.lock, torch.inference_mode():
+            extra_args = {}
+            if seed is not None:
+                extra_args['generator'] = torch.Generator().manual_seed(seed)
+            if use_ip:
+                # the UNet with the adapter expects image embeddings, the reference style is switched off
+                embeds = self.ip_cache.get(pipe, ip_ref_img, model_id, self.device)
+                extra_args['ip_adapter_image_embeds'] = [e.chunk(2)[1] for e in embeds]
+                set_ip_scale(pipe, 0)
+
+            with autocast(self.device, pipe.unet.dtype):
+                with timer("pre-image"):
+                    return sd_maker.make_img(prompt, model_id=model_id, pipe=pipe, **extra_args)
+
+    def _device_usage(self, extra_key=None):
+        keys = set(self.on_device)
+        if extra_key is not None:
+            keys.add(extra_key)
+        return sum(self.sizes[k] for k in keys)
+
+    def _over_budget(self, keep):
+        n = len(self.on_device | {keep})
+        if n > self.max_on_device:
+            return True
+        if self.device_budget is not None and n > 1:
+            return self._device_usage(extra_key=keep) > self.device_budget
+        return False
+
+    def _wait_unpinned(self, key):
+        """
+        Waits (lock released) until no warm-up uses a pipeline. Returns False if it was discarded in the meantime
+        """
+        if self.pins[key] > 0:
+            print(f'waiting for the warm-up of {key[0]}')
+        while self.pins[key] > 0:
+            self.unpinned.wait()
+        return key in self.pipes
+
+    def _evict(self, keep):
+        # first step: move the least recently used pipelines to the CPU
+        for key in list(self.pipes):
+            if not self._over_budget(keep):
+                break
+            if key != keep and key in self.on_device and self._wait_unpinned(key) and key in self.on_device:
+                print(f'moving {key[0]} to CPU')
+                self.pipes[key].to(device="cpu")
+                self.on_device.discard(key)
+
+        # second step: discard the least recently used pipelines
+        for key in list(self.pipes):
+            if len(self.pipes) <= self.max_loaded:
+                break
+            if key != keep and self._wait_unpinned(key) and len(self.pipes) > self.max_loaded:
+                print(f'discarding {key[0]}')
+                self.buckets.release(self.pipes[key])
+                del self.pipes[key]
+                del self.sizes[key]
+                self.on_device.discard(key)
+
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
 
-    return infer
\ No newline at end of file
+    def clear(self):
+        with self.lock:
+            self.pipes.clear()
+            self.sizes.clear()
+            self.on_device.clear()
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
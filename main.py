@@ -1,14 +1,19 @@
+import time
+start_time = time.perf_counter()  # reference for the startup timings, before any import
+
 from PySide6.QtGui import *
 from PySide6.QtWidgets import *
 from PySide6.QtCore import *
 
 import widgets as wid
-import sd_maker as sdxl
+import workers as wk
+import imaging
+import capture
+import metrics
 import resources as res
 from lcm import *
 from PIL import Image
 
-import torch
 import os
 import gc
 
@@ -28,19 +33,11 @@ def new_dir(dir_path):
 
 
 def scene_to_image(viewer):
-    # Define the size of the image (same as the scene's bounding rect)
-    image = QImage(viewer.viewport().size(), QImage.Format_ARGB32_Premultiplied)
-
-    # Create a QPainter to render the scene into the QImage
-    painter = QPainter(image)
-    viewer.render(painter)
-    painter.end()
-
-    file_path = 'input.png'
-    image.save(file_path)
+    # Render the view (same size as the viewport) into a QImage
+    image = imaging.render_view(viewer)
 
-    # Convert the BytesIO object to a PIL Image
-    pil_img = Image.open(file_path)
+    # Convert the QImage buffer to a PIL Image, in memory
+    pil_img = imaging.qimage_to_pil(image)
     return pil_img
 
 
@@ -132,8 +129,27 @@ class PaintLCM(QMainWindow):
         self.comboBox.addItems(self.models)
 
         # initial parameters
-        self.infer = load_models()
+        # loaded pipelines are kept in a LRU cache, so going back to a model (or IP-Adapter state) does not reload it
+        server_address = os.environ.get("FOCUSPOCUS_SERVER")
+        if server_address:
+            # thin client: the pipelines live in an inference server process (see server.py)
+            import server
+            self.pipelines = server.RemotePipelineManager(server_address)
+            self.compile_action.setEnabled(False)
+        else:
+            self.pipelines = PipelineManager()
+        self.infer = None  # set when the model is loaded, in the background
+        self.first_image = True
         self.im = None
+        self.out = None
+        self.seed = 1337
+        self.last_request = None
+        self.last_context = {}
+
+        # variants mode: several seeds generated in one batch, shown as a grid
+        self.n_variants = 4
+        self.variants = []
+        self.variant_seeds = []
         self.original_parent = None
 
         # pre-img parameters
@@ -237,11 +253,19 @@ class PaintLCM(QMainWindow):
         self.color_action.triggered.connect(self.canvas.set_color)
         self.export_action.triggered.connect(self.save_output)
         self.sequence_action.triggered.connect(self.record_sequence)
+        self.export_metrics_action.triggered.connect(self.export_metrics)
         self.capture_action.triggered.connect(self.toggle_capture)
         self.webcam_action.triggered.connect(self.toggle_webcam_capture)
         self.size_action.triggered.connect(self.update_img_dim)
         self.actionFull_screen_output.triggered.connect(self.toggle_fullscreen)
         self.actionLoad_IP_Adapter_reference_image.triggered.connect(self.define_ip_ref)
+        self.threshold_action.triggered.connect(self.set_change_threshold)
+        self.variants_action.triggered.connect(self.update_image)
+        self.fast_vae_action.triggered.connect(self.update_image)
+        self.adaptive_action.triggered.connect(self.toggle_adaptive_quality)
+        self.compile_action.triggered.connect(self.toggle_compiled)
+        self.tiled_action.triggered.connect(self.update_image)
+        self.result_canvas.variantSelected.connect(self.promote_variant)
         self.pushButton.clicked.connect(self.update_image)
         self.pushButton_preimg.clicked.connect(self.generate_preimage)
 
@@ -250,6 +274,9 @@ class PaintLCM(QMainWindow):
 
         # when editing canvas --> update inference
         self.canvas.endDrawing.connect(self.update_brush_stroke)
+        self.canvas.canvasDirty.connect(self.update_stroke_in_progress)
+        self.undo_shortcut = QShortcut(QKeySequence.Undo, self)
+        self.undo_shortcut.activated.connect(self.undo_stroke)
 
         # combobox
         self.comboBox.currentIndexChanged.connect(self.change_inference_model)
@@ -272,18 +299,85 @@ class PaintLCM(QMainWindow):
 
         # drawing ends
 
+        # inference runs in a background thread, results come back through a signal
+        self.worker = wk.InferenceWorker(self.infer)
+        self.worker.resultReady.connect(self.show_result)
+        self.worker.inferenceFailed.connect(self.inference_failed)
+        self.worker.start()
+
+        # models are loaded and warmed up in the background, the window shows up immediately
+        self.loader = wk.ModelLoader(self.load_model)
+        self.loader.progress.connect(self.show_loading)
+        self.loader.modelLoaded.connect(self.model_loaded)
+        self.loader.loadFailed.connect(self.model_failed)
+        self.loader.start()
+
+        # compiled mode: resolution buckets are compiled in the background, the eager UNet is used meanwhile
+        self.warmer = wk.TaskWorker()
+        self.warmer.taskFailed.connect(lambda msg: print(f'warm-up failed: {msg}'))
+        self.warmer.start()
+        self.pipelines.on_cold = self.warm_bucket
+
+        self.loading_label = QLabel()
+        self.loading_bar = QProgressBar()
+        self.loading_bar.setRange(0, 0)  # busy indicator
+        self.loading_bar.setMaximumWidth(120)
+        self.statusbar.addWidget(self.loading_label)
+        self.statusbar.addWidget(self.loading_bar)
+
+        # full quality exports run in the background, the live preview goes on meanwhile
+        self.exporter = wk.TaskWorker()
+        self.exporter.taskDone.connect(self.output_saved)
+        self.exporter.taskFailed.connect(self.export_failed)
+        self.exporter.start()
+
+        # pre-images are generated in the background: the pipeline lock can be held by a load or an inference
+        self.preimager = wk.TaskWorker()
+        self.preimager.taskDone.connect(self.show_preimage)
+        self.preimager.taskFailed.connect(self.preimage_failed)
+        self.preimager.start()
+
         # add capture box
         self.box = wid.TransparentBox(self.img_dim)
         self.capture_interval = 1000  # milliseconds
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.captureScreen)
+        # frames are grabbed by a capture thread, the timer only takes the newest one
+        self.screen_capture = None
+        self.capture_seq = 0
+        self.capture_frame = None
+
+        # performance HUD in the status bar
+        self.hud_label = QLabel()
+        self.statusbar.addPermanentWidget(self.hud_label)
+        self.hud_timer = QTimer(self)
+        self.hud_timer.timeout.connect(self.update_hud)
+        self.hud_timer.start(1000)
+
+        # live inference while a stroke is in progress, rate limited by the inference latency
+        self.stroke_throttle = wk.AdaptiveThrottle(min_interval=0.05)
+        self.stroke_timer = QTimer(self)
+        self.stroke_timer.setSingleShot(True)
+        self.stroke_timer.timeout.connect(self.update_stroke_in_progress)
+
+        # adaptive quality: steps, working resolution and capture interval follow a frame rate budget
+        self.quality = wk.QualityController(target_fps=4.)
+        self.pause_timer = QTimer(self)
+        self.pause_timer.setSingleShot(True)
+        self.pause_timer.setInterval(800)
+        self.pause_timer.timeout.connect(self.render_full_quality)
+
+        # unchanged capture frames (e.g. a paused viewport) are not sent to inference
+        self.change_detector = imaging.FrameChangeDetector(threshold=2.)
+        self.stream_flush = 0
 
         # configure webcam capture
         self.camera_index = 0  # Assuming you are using the first camera
         self.capture_interval = 1000  # Set capture interval in milliseconds
         self.timer_webcam = QTimer()
         self.timer_webcam.timeout.connect(self.capture_webcam_image)
-        self.opencv_capture = cv2.VideoCapture(self.camera_index)
+        self.webcam = None  # camera reader thread, while the webcam capture is on
+        self.webcam_seq = 0
 
         # prepare sequence recording
         self.is_recording = False
@@ -306,8 +400,8 @@ class PaintLCM(QMainWindow):
         self.add_icon(res.find(f'img/movie{suf}.png'), self.sequence_action)
         self.add_icon(res.find(f'img/camera{suf}.png'), self.webcam_action)
 
-        # run first inference
-        self.update_image()
+        # load the first model, the first inference runs when it is ready
+        self.request_model("runwayml/stable-diffusion-v1-5", True)
 
     # general functions __________________________________________
     def toggle_fullscreen(self):
@@ -343,15 +437,146 @@ class PaintLCM(QMainWindow):
             None, "Save Image", "", "PNG Image (*.png);;JPEG Image (*.jpg *.jpeg *.JPEG)"
         )
 
-        # Save the image if a file path was provided, using high-quality settings for JPEG
+        # the full quality output is computed in the background, the file is saved when it is ready
         if file_path:
-            if file_path.lower().endswith('.jpg') or file_path.lower().endswith('.jpeg'):
-                self.out.save(file_path, 'JPEG', 100)
-            else:
-                self.out.save(file_path)  # PNG is lossless by default
+            self.statusbar.showMessage(f'exporting {os.path.basename(file_path)} at full quality...')
+            self.exporter.submit(file_path, self.full_quality_task())
+
+    def output_saved(self, file_path, out):
+        # Save the image using high-quality settings for JPEG
+        if file_path.lower().endswith('.jpg') or file_path.lower().endswith('.jpeg'):
+            out.save(file_path, 'JPEG', 100)
+        else:
+            out.save(file_path)  # PNG is lossless by default
 
+        self.statusbar.showMessage(f'result saved: {file_path}', 5000)
         print(f'result saved: {file_path}')
 
+    def export_failed(self, msg):
+        self.statusbar.showMessage(f'export failed: {msg}', 5000)
+        print(f'export failed: {msg}')
+
+    def full_quality_task(self):
+        """
+        Returns a function computing the current output at full quality: full VAE and, if the adaptive quality
+        reduced them, full steps and resolution (the live preview may use lower settings). The parameters are read
+        here, the function can run in another thread
+        """
+        request = self.last_request
+        context = self.last_context
+        out = self.out
+        if request is None or self.infer is None or not (request.get('fast_vae') or context.get('degraded')):
+            return lambda: out
+
+        request = dict(request, image=context['image'], num_inference_steps=context['steps'], fast_vae=False,
+                       stream=False, seed=self.seed)
+        request.pop('num_variants', None)
+        request.pop('seeds', None)
+        infer = self.infer
+        return lambda: infer(**request)
+
+    def update_hud(self):
+        reg = metrics.registry
+        reg.set_gauge('prompt_cache_hit_rate', self.pipelines.prompt_cache.hit_rate)
+        reg.set_gauge('ip_cache_hit_rate', self.pipelines.ip_cache.hit_rate)
+        metrics.sample_memory()
+        reg.snapshot()
+
+        inference = reg.histogram('inference')
+        text = (f"{reg.rate('output'):.1f} FPS | "
+                f"inference {inference['p50']:.0f} ms (p95 {inference['p95']:.0f}) | "
+                f"capture {reg.histogram('capture')['p50']:.0f} ms ({reg.rate('capture'):.0f} FPS) | "
+                f"queue {reg.gauge('queue_depth'):.0f} | "
+                f"dropped {reg.counter('dropped_frames')} | "
+                f"skipped {reg.counter('skipped_frames')} | "
+                f"prompt cache {self.pipelines.prompt_cache.hit_rate:.0%}")
+        if reg.gauge('gpu_memory_mb', None) is not None:
+            text += f" | GPU {reg.gauge('gpu_memory_mb') / 1024:.1f} GB"
+        if reg.gauge('cpu_memory_mb', None) is not None:
+            text += f" | RAM {reg.gauge('cpu_memory_mb') / 1024:.1f} GB"
+        self.hud_label.setText(text)
+
+    def export_metrics(self):
+        file_path, _ = QFileDialog.getSaveFileName(
+            None, "Export session metrics", "", "CSV file (*.csv);;JSON file (*.json)"
+        )
+        if file_path:
+            metrics.registry.export(file_path)
+            print(f'metrics saved: {file_path}')
+
+    def report_first_window(self):
+        elapsed = time.perf_counter() - start_time
+        metrics.registry.set_gauge('time_to_first_window', elapsed)
+        print(f'time to first window: {elapsed:.2f} s')
+
+    def request_model(self, model_id, use_ip):
+        self.requested_model = (model_id, use_ip)
+        # the loader thread must not read the widgets, the warm-up parameters are gathered here
+        self.warm_up_kwargs = dict(size=self.img_dim, prompt=self.textEdit.toPlainText())
+        if use_ip:
+            self.warm_up_kwargs['ip_ref_img'] = self.ip_ref_img
+        # bucket shapes compiled after the load: the current one and the ones of the previous sessions
+        self.warm_up_keys = []
+        if self.pipelines.compiled:
+            self.warm_up_keys = self.pipelines.buckets.known(model_id, use_ip)
+            key = self.current_bucket_key(model_id, use_ip)
+            if key is not None and key not in self.warm_up_keys:
+                self.warm_up_keys.insert(0, key)
+
+        self.show_loading(f'loading {model_id}')
+        self.loader.request(model_id, use_ip)
+
+    def load_model(self, model_id, use_ip, progress):
+        # runs in the loader thread
+        is_new = not self.pipelines.is_loaded(model_id, use_ip)
+        progress(f'loading {model_id}' if is_new else f'switching to {model_id}')
+        infer = self.pipelines.get_infer(model_id, use_ip)
+
+        if is_new:
+            progress(f'warming up {model_id}')
+            warm_up(infer, **self.warm_up_kwargs)
+        for key in self.warm_up_keys:
+            self.warm_bucket(key)
+        return infer
+
+    def current_bucket_key(self, model_id, use_ip):
+        bucket = self.pipelines.buckets.snap(self.img_dim)
+        if bucket is None:
+            return None
+        return self.pipelines.buckets.make_key(model_id, use_ip, bucket, guidance_scale=self.cfg_slider.value() / 10)
+
+    def warm_bucket(self, key):
+        # can be called from the inference and loader threads
+        kwargs = {k: v for k, v in self.warm_up_kwargs.items() if k != 'size'}
+        self.warmer.submit(key, lambda: self.pipelines.warm_up_bucket(key, **kwargs))
+
+    def toggle_compiled(self):
+        self.pipelines.compiled = self.compile_action.isChecked()
+        self.warmer.clear()
+        # new inference function (the pipeline is cached, no reload)
+        self.request_model(*self.requested_model)
+
+    def show_loading(self, message):
+        self.loading_label.setText(message)
+        self.loading_label.show()
+        self.loading_bar.show()
+
+    def model_loaded(self, infer, key):
+        if key != self.requested_model:
+            # the user already asked for another model, which is loading
+            return
+
+        self.loading_label.hide()
+        self.loading_bar.hide()
+        self.infer = infer
+        self.worker.set_infer(infer)
+        self.update_image()
+
+    def model_failed(self, msg):
+        print(f'loading failed: {msg}')
+        self.loading_label.setText('loading failed')
+        self.loading_bar.hide()
+
     def toggle_canvas(self):
         # Hide or show canvas based on checkbox state
         if self.checkBox_hide.isChecked():
@@ -365,9 +590,6 @@ class PaintLCM(QMainWindow):
     # Sequence record functionality __________________________________________
     def record_sequence(self):
         if self.sequence_action.isChecked():
-            # change flag
-            self.is_recording = True
-
             # let the user choose an output folder
             out_dir = str(QFileDialog.getExistingDirectory(self, "Select output_folder"))
             while not os.path.isdir(out_dir):
@@ -382,18 +604,25 @@ class PaintLCM(QMainWindow):
             new_dir(self.inf_folder)
             new_dir(self.input_folder)
 
+            # frames are encoded in the background as they are produced (PNG files are optional)
+            save_png = self.png_frames_action.isChecked()
+            self.inf_recorder = VideoRecorder(os.path.join(self.inf_folder, 'inference_video.mp4'), 10,
+                                              png_folder=self.inf_folder if save_png else None)
+            self.input_recorder = VideoRecorder(os.path.join(self.input_folder, 'input_video.mp4'), 10,
+                                                png_folder=self.input_folder if save_png else None)
+
+            # change flag
+            self.is_recording = True
+
         else:
             # change flag
             self.is_recording = False
-            self.compile_video()
+            for recorder in (self.inf_recorder, self.input_recorder):
+                error = recorder.stop()
+                if error is not None:
+                    self.statusbar.showMessage(f'recording failed: {error}')
             self.n_frame = 0
 
-    def compile_video(self):
-        path_inference = os.path.join(self.inf_folder, 'inference_video.mp4')
-        path_input = os.path.join(self.input_folder, 'input_video.mp4')
-        create_video(self.inf_folder, path_inference, 10)
-        create_video(self.input_folder, path_input, 10)
-
     # Inference parameters __________________________________________
     def define_ip_ref(self):
         try:
@@ -408,8 +637,9 @@ class PaintLCM(QMainWindow):
             self.ip_ref_img = img[0]
             self.ip_custom_path = img[0]
 
-        self.change_inference_model()
+        # the reference image is passed at each inference, no need to reload the model
         self.comboBox_ip_styles.setCurrentIndex(len(self.ip_img_paths)) # put combobox to 'custom'
+        self.update_image()
 
     def change_ip_style(self):
         idx = self.comboBox_ip_styles.currentIndex()
@@ -418,7 +648,8 @@ class PaintLCM(QMainWindow):
         else:
             self.ip_ref_img = self.ip_custom_path
 
-        self.change_inference_model()
+        self.update_image()
+
     def toggle_ip(self):
         if self.checkBox_ip.isChecked():
             self.comboBox_ip_styles.setEnabled(True)
@@ -432,15 +663,24 @@ class PaintLCM(QMainWindow):
         idx = self.comboBox.currentIndex()
         self.model_id = self.models_ids[idx]
 
-        # Attempt to free up memory by explicitly deleting the previous model and calling garbage collector
-        if hasattr(self, 'infer'):
-            del self.infer
-            gc.collect()
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-
-        self.infer = load_models(model_id=self.model_id, use_ip=use_ip, ip_ref_img=self.ip_ref_img)
-        self.update_image()
+        # the pipeline manager only loads the model if it is not cached, and handles memory
+        self.worker.set_infer(None)
+        self.pipelines.prompt_cache.clear()
+        self.request_model(self.model_id, use_ip)
+
+    def set_change_threshold(self):
+        value, ok = QInputDialog.getDouble(self, "Capture change threshold",
+                                           "Minimum mean pixel difference (0-255) to run a new inference:",
+                                           self.change_detector.threshold, 0, 255, 1)
+        if ok:
+            self.change_detector.threshold = value
+
+    def promote_variant(self, idx):
+        # the chosen variant becomes the output, and its seed is kept for the next inferences
+        self.out = self.variants[idx]
+        self.seed = self.variant_seeds[idx]
+        self.variants_action.setChecked(False)
+        self.result_canvas.setPhoto(pixmap=imaging.pil_to_qpixmap(self.out))
 
     def update_img_dim(self):
         # open dialog for image size
@@ -458,6 +698,12 @@ class PaintLCM(QMainWindow):
 
         self.box = wid.TransparentBox(self.img_dim)
 
+        # the new size is compiled before it is needed
+        if self.pipelines.compiled:
+            key = self.current_bucket_key(*self.requested_model)
+            if key is not None:
+                self.warm_bucket(key)
+
     # Webcam capture __________________________________________
 
     def toggle_webcam_capture(self):
@@ -473,7 +719,10 @@ class PaintLCM(QMainWindow):
             # remove existing items
             self.canvas.clear_drawing()
 
-            # launch capture
+            # launch capture: the camera is read continuously by a thread, the timer only takes the newest frame
+            self.webcam = capture.WebcamCapture(self.camera_index, size=self.img_dim)
+            self.webcam.start()
+            self.webcam_seq = 0
             self.timer_webcam.start(self.capture_interval)
 
         else:
@@ -484,35 +733,30 @@ class PaintLCM(QMainWindow):
             self.color_action.setEnabled(True)
             self.capture_action.setEnabled(True)
 
+            # stop capture (releases the camera)
             self.timer_webcam.stop()
-            # stop capture
+            self.stop_webcam()
 
-    def capture_webcam_image(self):
-        ret, frame = self.opencv_capture.read()
-        # check if 'inverse' checkbox
-        if self.checkBox_inverse.isChecked():
-            frame = cv2.flip(frame, 0)
-            frame = cv2.flip(frame, 1)
-        if ret:
-            # Convert the captured frame to QImage then to QPixmap
-            height, width, channels = frame.shape
-            bytes_per_line = channels * width
-            qimage = QImage(frame.data, width, height, bytes_per_line, QImage.Format_BGR888)
-            pixmap = QPixmap.fromImage(qimage)
-            self.canvas.clear_drawing()
-            self.canvas.setPhoto(pixmap)
-
-            if self.checkBox.isChecked():
-                self.update_image()
-        else:
-            print("Failed to capture image")
+    def stop_webcam(self):
+        if self.webcam is not None:
+            self.webcam.stop()
+            self.webcam = None
 
-    # Other methods...
+    def capture_webcam_image(self):
+        # flip, crop and resize are done by the camera thread
+        self.webcam.inverse = self.checkBox_inverse.isChecked()
+        self.webcam.set_size(self.img_dim)
+        seq, frame = self.webcam.latest(after=self.webcam_seq)
+        if frame is None:
+            # no new frame since the last tick
+            return
+        self.webcam_seq = seq
+
+        self.canvas.clear_drawing()
+        self.canvas.setPhoto(QPixmap.fromImage(imaging.array_to_qimage(frame)))
 
-    def closeEvent(self, event):
-        # Make sure to release the camera when closing the application
-        self.opencv_capture.release()
-        super().closeEvent(event)
+        if self.checkBox.isChecked():
+            self.update_capture()
 
     # Screen capture __________________________________________
     def toggle_capture(self):
@@ -530,6 +774,10 @@ class PaintLCM(QMainWindow):
 
             # launch capture
             self.box.show()
+            self.screen_capture = capture.ScreenCapture(backend='auto', fps=30.)
+            self.screen_capture.set_region(self.capture_region(), self.box.screen().devicePixelRatio())
+            self.screen_capture.start()
+            self.capture_seq = 0
             self.timer.start(self.capture_interval)
 
         else:
@@ -542,28 +790,85 @@ class PaintLCM(QMainWindow):
 
             self.timer.stop()
             # stop capture
+            self.stop_screen_capture()
             self.box.hide()
 
-    def captureScreen(self):
-        # Get geometry of the transparent box
+    def capture_region(self):
+        # inside of the transparent box, without its border
         x, y, width, height = self.box.geometry().getRect()
-        print(width, height)
+        return x + 6, y + 6, width - 12, height - 12
 
-        screen = QApplication.primaryScreen()
-        if screen is not None:
-            pixmap = screen.grabWindow(0, x + 6, y + 6, width - 12, height - 12)
+    def stop_screen_capture(self):
+        if self.screen_capture is not None:
+            self.screen_capture.stop()
+            self.screen_capture = None
 
-            self.canvas.setPhoto(pixmap)
+    def captureScreen(self):
+        # the box can be moved or resized at any time
+        self.screen_capture.set_region(self.capture_region(), self.box.screen().devicePixelRatio())
+        # without mss, the Qt grab runs here, on the GUI thread
+        self.screen_capture.poll()
+
+        seq, frame = self.screen_capture.latest(after=self.capture_seq)
+        if frame is not None:
+            self.capture_seq = seq
+            # the QImage wraps the array, which must stay alive until the pixmap is created
+            self.capture_frame = frame
+            self.canvas.setPhoto(QPixmap.fromImage(imaging.array_to_qimage(frame)))
 
         # should it update continuously
         if self.checkBox.isChecked():
-            self.update_image()
+            self.update_capture()
 
     def closeEvent(self, event):
         # Explicitly close the transparent box when the main window is closed
         self.box.close()
+        self.stop_screen_capture()
+        self.stop_webcam()
+        self.loader.stop()
+        self.warmer.stop()
+        self.worker.stop()
+        self.exporter.stop()
+        self.preimager.stop()
         event.accept()
 
+    def update_stroke_in_progress(self):
+        if not (self.checkBox.isChecked() and self.stroke_stream_action.isChecked() and self.canvas.drawing):
+            return
+
+        # never queue more work than the engine can handle: wait for the pending request and the latency interval
+        remaining = self.stroke_throttle.remaining()
+        if self.worker.pending() or remaining > 0:
+            if not self.stroke_timer.isActive():
+                self.stroke_timer.start(max(10, int(remaining * 1000)))
+            return
+
+        self.stroke_throttle.mark()
+        self.update_image()
+
+    def toggle_adaptive_quality(self):
+        if self.adaptive_action.isChecked():
+            value, ok = QInputDialog.getDouble(self, "Adaptive quality", "Target frame rate (FPS):",
+                                               self.quality.target_fps, 0.1, 60, 1)
+            if not ok:
+                self.adaptive_action.setChecked(False)
+                return
+            self.quality.target_fps = value
+        else:
+            self.pause_timer.stop()
+            self.timer.setInterval(self.capture_interval)
+            self.timer_webcam.setInterval(self.capture_interval)
+        self.quality.reset()
+
+    def render_full_quality(self):
+        # the user paused: the last input is rendered again with the full settings
+        if self.last_context.get('degraded') and not self.worker.pending():
+            self.submit_inference(self.last_context['image'], full_quality=True)
+
+    def undo_stroke(self):
+        self.canvas.undo()
+        self.update_brush_stroke()
+
     def update_brush_stroke(self):
         if self.checkBox.isChecked():
             self.update_image()
@@ -573,12 +878,49 @@ class PaintLCM(QMainWindow):
 
         self.style = i
     def generate_preimage(self):
+        if self.infer is None:
+            print('the model is not loaded yet')
+            return
+
         p = self.style_prompts[self.style]
-        im = sdxl.make_img(p, model_id=self.model_id)
-        im.save('preimg.jpg')
+        # the loaded pipeline is reused, its ip scale is set again by the next inference
+        model_id, use_ip = self.requested_model
+        ip_ref_img = self.ip_ref_img
+        self.pushButton_preimg.setEnabled(False)
+        self.preimager.submit((p, model_id, use_ip),
+                              lambda: self.pipelines.text_to_image(p, model_id, use_ip, ip_ref_img=ip_ref_img))
+
+    def show_preimage(self, key, im):
+        self.pushButton_preimg.setEnabled(True)
+        self.canvas.setPhoto(imaging.pil_to_qpixmap(im))
+
+    def preimage_failed(self, msg):
+        self.pushButton_preimg.setEnabled(True)
+        print(f'pre-image failed: {msg}')
 
-        self.canvas.setPhoto(QPixmap('preimg.jpg'))
     def update_image(self):
+        self.im = scene_to_image(self.canvas)
+        self.submit_inference(self.im)
+
+    def update_capture(self):
+        """
+        Inference for capture frames: skipped when the frame did not change since the last inference
+        """
+        im = scene_to_image(self.canvas)
+        if self.change_detector.has_changed(im):
+            # with stream batching, the last frame is pushed again until all the frames in flight are out
+            self.stream_flush = self.step_slider.value() - 1 if self.stream_action.isChecked() else 0
+        elif self.stream_flush > 0:
+            self.stream_flush -= 1
+        else:
+            # the previous output stays displayed
+            metrics.registry.increment('skipped_frames')
+            return
+
+        self.im = im
+        self.submit_inference(self.im, stream=self.stream_action.isChecked())
+
+    def submit_inference(self, im, stream=False, full_quality=False):
         # gather slider parameters:
         steps = self.step_slider.value()
         cfg = self.cfg_slider.value() / 10
@@ -590,38 +932,79 @@ class PaintLCM(QMainWindow):
         p = self.textEdit.toPlainText()
         np = self.textEdit_negative.toPlainText()
 
-        print(
-            f'here are the parameters \n steps: {steps}\n cfg: {cfg}\n image strength: {image_strength}\n prompt: {p}')
-
-        print('capturing drawing')
-        self.im = scene_to_image(self.canvas)
-        self.im.save('input.png')
+        self.change_detector.set_reference(im)
 
-        # capture painted image
+        # full quality parameters are kept with the request, to render the final image when the user pauses
+        context = {'image': im, 'steps': steps, 'full_quality': full_quality}
+        if self.adaptive_action.isChecked() and not full_quality:
+            steps, size = self.quality.apply(steps, im.size, strength=image_strength)
+            context['degraded'] = self.quality.is_degraded()
+            if size != im.size:
+                # working resolution, the result is upscaled by the result canvas
+                im = im.resize(size, Image.BILINEAR)
+            self.pause_timer.start()
 
-        print('running inference')
-        self.out = self.infer(
+        request = dict(
             prompt=p,
             negative_prompt=np,
-            image='input.png',
+            image=im,
             num_inference_steps=steps,
             guidance_scale=cfg,
             strength=image_strength,
-            seed=1337,
-            ip_scale=ip_strength
+            seed=self.seed,
+            ip_scale=ip_strength,
+            ip_ref_img=self.ip_ref_img,
+            # the tiny autoencoder is only used for the live preview, recorded frames use the full VAE
+            fast_vae=self.fast_vae_action.isChecked() and not self.is_recording,
+            # capture frames can be denoised in a rolling batch
+            stream=stream,
+            # large images are denoised in tiles, with a bounded memory
+            tiled=self.tiled_action.isChecked()
         )
+        if self.variants_action.isChecked():
+            request['num_variants'] = self.n_variants
+            request['seeds'] = [self.seed + i for i in range(self.n_variants)]
+
+        # send the request to the inference thread (replaces any request still waiting)
+        self.worker.submit(request, context)
+
+    def inference_failed(self, msg, context):
+        print(f'inference failed: {msg}')
+        if self.adaptive_action.isChecked() and not context.get('full_quality'):
+            self.quality.update_failed(context.get('latency', 0.))
+
+    def show_result(self, out, request, context):
+        if self.first_image:
+            self.first_image = False
+            elapsed = time.perf_counter() - start_time
+            metrics.registry.set_gauge('time_to_first_image', elapsed)
+            print(f'time to first image: {elapsed:.2f} s')
+
+        self.last_request = request
+        self.last_context = context
+
+        if self.adaptive_action.isChecked() and not context.get('full_quality'):
+            self.quality.update(context['latency'])
+            # capture ticks follow the inference latency
+            interval = self.quality.capture_interval(self.capture_interval)
+            self.timer.setInterval(interval)
+            self.timer_webcam.setInterval(interval)
+
+        if isinstance(out, list):
+            # variants: show the grid, the first one is the default output
+            self.variants = out
+            self.variant_seeds = request['seeds']
+            self.out = out[0]
+            self.result_canvas.setVariants([imaging.pil_to_qpixmap(im) for im in out])
+        else:
+            self.out = out
+            self.result_canvas.setPhoto(pixmap=imaging.pil_to_qpixmap(self.out))
 
-        self.out.save('result.jpg')
-        print('result saved')
-
-        self.result_canvas.setPhoto(pixmap=QPixmap('result.jpg'))
-
-        # save images if recording flag
+        # send images to the video encoders if recording flag
         if self.is_recording:
             self.n_frame += 1
-            frame_path = f"frame_{self.n_frame:04}.png"
-            self.out.save(os.path.join(self.inf_folder, frame_path))
-            self.im.save(os.path.join(self.input_folder, frame_path))
+            self.inf_recorder.add_frame(self.out)
+            self.input_recorder.add_frame(context['image'])
 
 
 def main(argv=None):
@@ -680,6 +1063,8 @@ def main(argv=None):
     print('Launching the application')
     window = PaintLCM(is_dark_theme)
     window.show()
+    # measured once the event loop has painted the window
+    QTimer.singleShot(0, window.report_first_window)
 
     # run the application if necessary
     if (app):
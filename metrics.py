@@ -0,0 +1,189 @@
+""" Live performance metrics: counters, gauges and rolling latency histograms, shared by the whole application."""
+
+import csv
+import json
+import sys
+import threading
+import time
+from collections import deque
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class Histogram:
+    """
+    Rolling window of the last values (e.g. latencies in ms)
+    """
+    def __init__(self, size=100):
+        self.values = deque(maxlen=size)
+        self.count = 0
+
+    def observe(self, value):
+        self.values.append(value)
+        self.count += 1
+
+    def percentile(self, q):
+        if not self.values:
+            return 0.
+        values = sorted(self.values)
+        idx = min(len(values) - 1, int(q / 100 * len(values)))
+        return values[idx]
+
+    def summary(self):
+        n = len(self.values)
+        return {
+            'count': self.count,
+            'mean': sum(self.values) / n if n else 0.,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+        }
+
+
+class MetricsRegistry:
+    """
+    Thread-safe registry of named counters, gauges and histograms.
+    Snapshots can be recorded along the session and exported to JSON or CSV, only the last max_snapshots are kept.
+    """
+    def __init__(self, histogram_size=100, rate_window=5., max_snapshots=3600):
+        self.histogram_size = histogram_size
+        self.rate_window = rate_window
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.events = {}  # name --> timestamps, for rates (e.g. frames per second)
+        self.snapshots = deque(maxlen=max_snapshots)  # one per second in the HUD: the last hour
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(self.histogram_size)
+            self.histograms[name].observe(value)
+
+    def mark(self, name):
+        """
+        Records an event, see rate()
+        """
+        with self.lock:
+            if name not in self.events:
+                self.events[name] = deque(maxlen=1000)
+            self.events[name].append(time.perf_counter())
+
+    def rate(self, name):
+        """
+        Events per second over the last rate_window seconds
+        """
+        with self.lock:
+            stamps = self.events.get(name)
+            if not stamps:
+                return 0.
+            now = time.perf_counter()
+            recent = [t for t in stamps if now - t <= self.rate_window]
+        if len(recent) < 2:
+            return 0.
+        return (len(recent) - 1) / (recent[-1] - recent[0])
+
+    def counter(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def gauge(self, name, default=0.):
+        with self.lock:
+            return self.gauges.get(name, default)
+
+    def histogram(self, name):
+        with self.lock:
+            if name in self.histograms:
+                return self.histograms[name].summary()
+            return Histogram().summary()
+
+    def timed(self, name):
+        return _Timed(self, name)
+
+    def snapshot(self):
+        """
+        Returns the current state as a flat dict, and keeps it in the session history
+        """
+        with self.lock:
+            snap = {'time': round(time.time() - self.start_time, 3)}
+            snap.update({f'counter.{k}': v for k, v in self.counters.items()})
+            snap.update({f'gauge.{k}': v for k, v in self.gauges.items()})
+            for name, histogram in self.histograms.items():
+                for k, v in histogram.summary().items():
+                    snap[f'{name}.{k}'] = v
+            rate_names = list(self.events)
+        for name in rate_names:
+            snap[f'rate.{name}'] = self.rate(name)
+
+        with self.lock:
+            self.snapshots.append(snap)
+        return snap
+
+    def export(self, file_path):
+        """
+        Writes the session snapshots to a CSV file, or to a JSON file (with the last state)
+        """
+        with self.lock:
+            snapshots = list(self.snapshots)
+
+        if file_path.lower().endswith('.csv'):
+            columns = []
+            for snap in snapshots:
+                columns += [k for k in snap if k not in columns]
+            with open(file_path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=columns)
+                writer.writeheader()
+                writer.writerows(snapshots)
+        else:
+            with self.lock:
+                state = {
+                    'counters': dict(self.counters),
+                    'gauges': dict(self.gauges),
+                    'histograms': {k: h.summary() for k, h in self.histograms.items()},
+                }
+            with open(file_path, 'w') as f:
+                json.dump({'final': state, 'snapshots': snapshots}, f, indent=2)
+
+
+class _Timed:
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.registry.observe(self.name, (time.perf_counter() - self.start) * 1000)
+
+
+def sample_memory(reg=None):
+    """
+    Updates the memory gauges (MB): GPU memory if torch is loaded, and process memory if psutil is available
+    """
+    if reg is None:
+        reg = registry
+
+    torch = sys.modules.get('torch')  # never import torch only for metrics
+    if torch is not None and torch.cuda.is_available():
+        reg.set_gauge('gpu_memory_mb', torch.cuda.memory_allocated() / 2**20)
+        reg.set_gauge('gpu_memory_reserved_mb', torch.cuda.memory_reserved() / 2**20)
+    if psutil is not None:
+        reg.set_gauge('cpu_memory_mb', psutil.Process().memory_info().rss / 2**20)
+
+
+# application-wide registry
+registry = MetricsRegistry()
@@ -1,10 +1,27 @@
-from diffusers import DiffusionPipeline, LCMScheduler
-import torch
 from os import path
 
 cache_path = path.join(path.dirname(path.abspath(__file__)), "models")
 
-def make_img(p, model_id="Lykon/dreamshaper-7"):
+def make_img(p, model_id="Lykon/dreamshaper-7", pipe=None, **kwargs):
+    """
+    Generates an image from a prompt.
+    :param pipe: loaded pipeline of model_id (e.g. the img2img pipeline of the live inference). Its components are
+    reused by a text-to-image pipeline, no model is loaded. If None, a pipeline is loaded for this image only
+    :param kwargs: other arguments of the pipeline call
+    """
+    # heavy imports, only when a pre-image is requested
+    from diffusers import AutoPipelineForText2Image, DiffusionPipeline, LCMScheduler
+    import torch
+
+    if pipe is not None:
+        # same UNet, VAE and text encoders: no extra memory
+        return AutoPipelineForText2Image.from_pipe(pipe)(
+            prompt=p,
+            num_inference_steps=6,
+            guidance_scale=1,
+            **kwargs
+        ).images[0]
+
     lcm_lora_id = "latent-consistency/lcm-lora-sdv1-5"
     if model_id == "stabilityai/stable-diffusion-xl-base-1.0":
         lcm_lora_id = "latent-consistency/lcm-lora-sdxl"
@@ -18,8 +35,9 @@ def make_img(p, model_id="Lykon/dreamshaper-7"):
         prompt=p,
         num_inference_steps=6,
         guidance_scale=1,
+        **kwargs
     ).images[0]
 
     del pipe
 
-    return images
\ No newline at end of file
+    return images
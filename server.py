@@ -0,0 +1,449 @@
+"""
+Out-of-process inference: the LCM engine runs in a local server process, GUIs and headless tools are thin clients.
+
+Clients talk to the server over a Unix socket (a named pipe on Windows, or localhost TCP). Images are not serialized:
+they are passed through shared memory blocks, reused from one request to the other. Each connection is served by its
+own thread, all of them share the pipeline manager: several FocusPocus windows (or batch runs) use one warm model.
+A slow or crashing inference only affects the server, the client gets an error.
+
+Messages are pickled, so the server only accepts local clients of the same user: TCP addresses must be on the
+loopback interface, and connections are authenticated with a random key kept in a per-user file (mode 0600), next to
+the default socket in ~/.focuspocus (mode 0700).
+
+Example:
+    python server.py                 # real models
+    python server.py --stub          # stub pipeline on the CPU (no model, no GPU)
+    FOCUSPOCUS_SERVER=default python main.py
+    python batch.py captures -o results --server default
+"""
+
+import argparse
+import ipaddress
+import os
+import secrets
+import socket
+import sys
+import tempfile
+import threading
+from multiprocessing import AuthenticationError, resource_tracker
+from multiprocessing.connection import Client, Listener
+from multiprocessing.shared_memory import SharedMemory
+
+import lcm
+import resources as res
+
+
+def private_dir():
+    """
+    Per-user folder holding the authentication key and the default socket, only accessible by the user
+    """
+    folder = os.path.join(os.path.expanduser("~"), ".focuspocus")
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    if os.name == "posix":
+        os.chmod(folder, 0o700)
+    return folder
+
+
+def auth_key():
+    """
+    Random key shared by the server and the clients of a user (FOCUSPOCUS_AUTHKEY overrides it)
+    """
+    if os.environ.get("FOCUSPOCUS_AUTHKEY"):
+        return os.environ["FOCUSPOCUS_AUTHKEY"].encode()
+
+    folder = private_dir()
+    key_path = os.path.join(folder, "authkey")
+    if not os.path.exists(key_path):
+        # written aside (mkstemp: mode 0600) then linked: the first process wins, a partial key is never read
+        fd, tmp_path = tempfile.mkstemp(dir=folder)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(tmp_path, key_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(key_path) as f:
+        return f.read().strip().encode()
+
+
+def default_address():
+    if sys.platform == "win32":
+        return r"\\.\pipe\focuspocus-" + os.environ.get("USERNAME", "user")
+    return os.path.join(private_dir(), "server.sock")
+
+
+def is_loopback(host):
+    try:
+        return all(ipaddress.ip_address(info[4][0]).is_loopback for info in socket.getaddrinfo(host, None))
+    except (socket.gaierror, ValueError):
+        return False
+
+
+def parse_address(address):
+    """
+    'default', a Unix socket path, a Windows pipe name, 'host:port' or (host, port) on the loopback interface.
+    Parsed addresses are returned as they are: they can be parsed again
+    """
+    if address in (None, "", "default"):
+        return default_address()
+    if isinstance(address, str):
+        if address.startswith("\\\\") or ":" not in address or os.path.isabs(address):
+            return address
+        address = address.rsplit(":", 1)
+    host, port = address
+    if not is_loopback(host):
+        raise ValueError(f"{host} is not a loopback address: the inference server only accepts local clients")
+    return host, int(port)
+
+
+# blocks created by this process (the server and a client can share a process, e.g. in tests)
+owned_blocks = set()
+
+
+def attach(name):
+    """
+    Attaches to a shared memory block created by the other process
+    """
+    shm = SharedMemory(name=name)
+    if os.name == "posix" and shm._name not in owned_blocks:
+        # the block belongs to the other process: it must not be unlinked when this one exits
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class SharedBuffer:
+    """
+    Shared memory block owned by this process, grown when a larger content is written
+    """
+    def __init__(self):
+        self.shm = None
+
+    def write(self, arrays):
+        """
+        Copies uint8 arrays one after the other in the block
+        :return: list of (offset, shape) descriptors, with the block name
+        """
+        import numpy as np
+
+        size = sum(a.nbytes for a in arrays)
+        if self.shm is None or self.shm.size < size:
+            self.close()
+            self.shm = SharedMemory(create=True, size=max(size, 1))
+            owned_blocks.add(self.shm._name)
+
+        descriptors = []
+        offset = 0
+        for a in arrays:
+            view = np.ndarray(a.shape, dtype=np.uint8, buffer=self.shm.buf, offset=offset)
+            view[...] = a
+            descriptors.append((offset, a.shape))
+            offset += a.nbytes
+        return {'name': self.shm.name, 'arrays': descriptors}
+
+    def close(self):
+        if self.shm is not None:
+            owned_blocks.discard(self.shm._name)
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class SharedReader:
+    """
+    Reads arrays from the blocks of the other process, keeping the last attached block open
+    """
+    def __init__(self):
+        self.shm = None
+
+    def read(self, desc):
+        """
+        :return: list of PIL images (copies: the block is reused by the next request)
+        """
+        import numpy as np
+        from PIL import Image
+
+        if self.shm is None or self.shm.name != desc['name']:
+            self.close()
+            self.shm = attach(desc['name'])
+        return [Image.fromarray(np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf, offset=offset).copy())
+                for offset, shape in desc['arrays']]
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+
+
+def to_arrays(images):
+    import numpy as np
+
+    return [np.asarray(im.convert('RGB')) for im in images]
+
+
+class StubPipelineManager:
+    """
+    Stand-in for lcm.PipelineManager, built on the stub inference function (no model, CPU only)
+    """
+    def __init__(self, delay=0.):
+        self.delay = delay
+        self.loaded = set()
+
+    def is_loaded(self, model_id, use_ip):
+        return (model_id, use_ip) in self.loaded
+
+    def get(self, model_id, use_ip):
+        self.loaded.add((model_id, use_ip))
+
+    def get_infer(self, model_id, use_ip, ip_ref_img=None):
+        self.get(model_id, use_ip)
+        return lcm.load_stub_models(delay=self.delay)
+
+    def text_to_image(self, prompt, model_id, use_ip, ip_ref_img=None, seed=None):
+        from PIL import Image
+
+        self.get(model_id, use_ip)
+        return Image.new('RGB', (512, 512), 'white')
+
+
+class InferenceServer:
+    """
+    Serves a pipeline manager to local clients, one thread per connection
+    """
+    def __init__(self, manager, address=None):
+        self.manager = manager
+        self.address = parse_address(address)
+        self.listener = None
+
+    def serve_forever(self):
+        if isinstance(self.address, str) and not self.address.startswith("\\\\") and os.path.exists(self.address):
+            # socket file left by a previous server
+            os.remove(self.address)
+        self.listener = Listener(self.address, authkey=auth_key())
+        if isinstance(self.address, str) and os.name == "posix":
+            os.chmod(self.address, 0o600)
+        print(f'inference server listening on {self.address}')
+        try:
+            while True:
+                try:
+                    conn = self.listener.accept()
+                except (OSError, AuthenticationError):
+                    # listener closed, or a client failed to authenticate
+                    if self.listener is None:
+                        break
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.listener is not None:
+            listener, self.listener = self.listener, None
+            listener.close()
+
+    def handle(self, conn):
+        infers = {}  # one inference function per model: each client keeps its own stream state
+        reader = SharedReader()
+        output = SharedBuffer()
+        try:
+            while True:
+                try:
+                    msg = conn.recv()
+                except (EOFError, OSError):
+                    break
+                try:
+                    reply = self.dispatch(msg, infers, reader, output)
+                    reply['ok'] = True
+                except Exception as e:
+                    reply = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+                conn.send(reply)
+        finally:
+            reader.close()
+            output.close()
+            conn.close()
+
+    def dispatch(self, msg, infers, reader, output):
+        op = msg['op']
+        if op == 'ping':
+            return {}
+
+        if op == 'is_loaded':
+            return {'loaded': self.manager.is_loaded(*msg['model'])}
+
+        if op == 'load':
+            model = tuple(msg['model'])
+            is_new = not self.manager.is_loaded(*model)
+            infers[model] = self.manager.get_infer(*model)
+            return {'new': is_new}
+
+        if op == 'infer':
+            model = tuple(msg['model'])
+            if model not in infers:
+                infers[model] = self.manager.get_infer(*model)
+            request = dict(msg['request'], image=reader.read(msg['image'])[0])
+            out = infers[model](**request)
+            if out is None:
+                # stream batching, the frame is still in flight
+                return {'images': None, 'stats': self.stats()}
+            return {'images': output.write(to_arrays(out if isinstance(out, list) else [out])),
+                    'list': isinstance(out, list), 'stats': self.stats()}
+
+        if op == 'text_to_image':
+            out = self.manager.text_to_image(msg['prompt'], *msg['model'], **msg.get('kwargs', {}))
+            return {'images': output.write(to_arrays([out]))}
+
+        if op == 'stats':
+            return {'stats': self.stats()}
+
+        raise ValueError(f'unknown operation {op}')
+
+    def stats(self):
+        stats = {}
+        for name in ('prompt_cache', 'ip_cache'):
+            cache = getattr(self.manager, name, None)
+            if cache is not None:
+                stats[name] = cache.hit_rate
+        return stats
+
+
+class InferenceClient:
+    """
+    Connection to an inference server. Each thread uses its own connection and shared memory blocks, so that a
+    model load (loader thread) does not block the inference thread's requests on the client side.
+    """
+    def __init__(self, address=None):
+        self.address = parse_address(address)
+        self.local = threading.local()
+        self.stats = {}
+
+    def _channel(self):
+        local = self.local
+        if getattr(local, 'conn', None) is None:
+            local.conn = Client(self.address, authkey=auth_key())
+            local.input = SharedBuffer()
+            local.reader = SharedReader()
+        return local
+
+    def call(self, msg):
+        local = self._channel()
+        try:
+            local.conn.send(msg)
+            reply = local.conn.recv()
+        except (EOFError, OSError) as e:
+            # the server is gone: reconnect on the next call
+            self.disconnect()
+            raise ConnectionError(f'inference server unavailable: {e}')
+        if not reply['ok']:
+            raise RuntimeError(reply['error'])
+        self.stats.update(reply.get('stats', {}))
+        return reply
+
+    def disconnect(self):
+        local = self.local
+        if getattr(local, 'conn', None) is not None:
+            local.conn.close()
+            local.input.close()
+            local.reader.close()
+            local.conn = None
+
+    def ping(self):
+        self.call({'op': 'ping'})
+
+    def is_loaded(self, model_id, use_ip):
+        return self.call({'op': 'is_loaded', 'model': (model_id, use_ip)})['loaded']
+
+    def load(self, model_id, use_ip):
+        return self.call({'op': 'load', 'model': (model_id, use_ip)})['new']
+
+    def get_infer(self, model_id, use_ip):
+        """
+        Returns an inference function with the same signature as the one of lcm.load_models
+        """
+        self.load(model_id, use_ip)
+
+        def infer(image, **request):
+            from PIL import Image
+
+            if isinstance(image, str):
+                image = Image.open(image)
+            local = self._channel()
+            reply = self.call({'op': 'infer', 'model': (model_id, use_ip), 'request': request,
+                               'image': local.input.write(to_arrays([image]))})
+            if reply['images'] is None:
+                return None
+            images = local.reader.read(reply['images'])
+            return images if reply['list'] else images[0]
+
+        # the engine timings are recorded in the server process: the caller measures the round trip
+        infer.remote = True
+        return infer
+
+    def text_to_image(self, prompt, model_id, use_ip, **kwargs):
+        reply = self.call({'op': 'text_to_image', 'prompt': prompt, 'model': (model_id, use_ip), 'kwargs': kwargs})
+        return self._channel().reader.read(reply['images'])[0]
+
+
+class RemoteCacheStats:
+    """
+    Hit rate of a cache of the server, as seen in the last replies
+    """
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    @property
+    def hit_rate(self):
+        return self.client.stats.get(self.name, 0.)
+
+    def clear(self):
+        # the server caches are keyed by model, nothing to clear
+        pass
+
+
+class RemotePipelineManager:
+    """
+    Client-side stand-in for lcm.PipelineManager, as used by the GUI: pipelines live in the inference server.
+    The compiled mode is not available remotely.
+    """
+    compiled = False
+
+    def __init__(self, address=None):
+        self.client = InferenceClient(address)
+        self.prompt_cache = RemoteCacheStats(self.client, 'prompt_cache')
+        self.ip_cache = RemoteCacheStats(self.client, 'ip_cache')
+        self.on_cold = None
+
+    def is_loaded(self, model_id, use_ip):
+        return self.client.is_loaded(model_id, use_ip)
+
+    def get_infer(self, model_id, use_ip, ip_ref_img=None):
+        return self.client.get_infer(model_id, use_ip)
+
+    def text_to_image(self, prompt, model_id, use_ip, ip_ref_img=res.find('img/ref1.png'), seed=None):
+        return self.client.text_to_image(prompt, model_id, use_ip, ip_ref_img=ip_ref_img, seed=seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FocusPocus local inference server")
+    parser.add_argument('--address', default='default',
+                        help="Unix socket path, Windows pipe name or localhost:port (default: ~/.focuspocus/server.sock)")
+    parser.add_argument('--stub', action='store_true', help="use a stub pipeline on the CPU (no model)")
+    parser.add_argument('--stub-delay', type=float, default=0., help="simulated time per step of the stub (s)")
+    args = parser.parse_args(argv)
+    try:
+        address = parse_address(args.address)
+    except ValueError as e:
+        parser.error(str(e))
+
+    manager = StubPipelineManager(delay=args.stub_delay) if args.stub else lcm.PipelineManager()
+    server = InferenceServer(manager, address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the application modules live at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# widgets are built without a display
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
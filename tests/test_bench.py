@@ -0,0 +1,46 @@
+"""Tests of the latency benchmark, on the tiny pipeline (CPU, no download)."""
+
+import json
+
+import pytest
+
+pytest.importorskip('PySide6')
+pytest.importorskip('torch')
+pytest.importorskip('diffusers')
+
+import bench
+import lcm
+
+
+def test_model_name_is_resolved(tmp_path, monkeypatch):
+    calls = {}
+
+    def load_pipeline(model_id, device, **kwargs):
+        calls['load_pipeline'] = model_id
+        return lcm.build_tiny_pipeline().to(device)
+
+    def get_tiny_vae(model_id, device, dtype=None, random_weights=False):
+        calls['get_tiny_vae'] = model_id
+        return get_tiny_vae.original(model_id, device, dtype=dtype, random_weights=True)
+
+    def make_infer(pipe, model_id, **kwargs):
+        calls['make_infer'] = model_id
+        return make_infer.original(pipe, model_id, **kwargs)
+
+    get_tiny_vae.original = lcm.get_tiny_vae
+    make_infer.original = lcm.make_infer
+    monkeypatch.setattr(bench, 'load_pipeline', load_pipeline)
+    monkeypatch.setattr(lcm, 'get_tiny_vae', get_tiny_vae)
+    monkeypatch.setattr(lcm, 'make_infer', make_infer)
+
+    output = tmp_path / 'bench.json'
+    assert bench.main(['--model', 'SDXL 1.0', '--device', 'cpu', '--fast-vae', '--size', '64', '64',
+                       '--iterations', '1', '--warmup', '0', '-o', str(output)]) == 0
+    # the display name is only used in the report
+    assert calls == dict.fromkeys(['load_pipeline', 'get_tiny_vae', 'make_infer'],
+                                  'stabilityai/stable-diffusion-xl-base-1.0')
+
+    with open(output) as f:
+        results = json.load(f)
+    assert results['meta']['model'] == 'SDXL 1.0'
+    assert results['stages']['total']['count'] == 1
@@ -0,0 +1,92 @@
+"""Tests of the capture threads, with the synthetic backend (no screen)."""
+
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import capture
+
+
+class GuiThreadBackend(capture.SyntheticBackend):
+    """
+    Synthetic backend which, like the Qt one, must not be used from the capture thread
+    """
+    name = 'gui'
+    threaded = False
+
+    def __init__(self):
+        super().__init__()
+        self.threads = set()
+
+    def grab(self, region, out):
+        self.threads.add(threading.get_ident())
+        super().grab(region, out)
+
+
+def test_threaded_capture_serves_the_newest_frame():
+    screen = capture.ScreenCapture(backend='synthetic', fps=200.)
+    screen.set_region((0, 0, 64, 48))
+    screen.start()
+    try:
+        deadline = time.time() + 5
+        while screen.n_frames < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        seq, frame = screen.latest()
+        assert frame.shape == (48, 64, 3)
+        assert seq >= 3
+        assert screen.latest(after=screen.ring.seq + 1)[1] is None
+    finally:
+        screen.stop()
+
+
+def test_gui_thread_backend_grabs_on_poll():
+    backend = GuiThreadBackend()
+    screen = capture.ScreenCapture(backend=backend, fps=200.)
+    screen.set_region((0, 0, 32, 32))
+    screen.start()
+    try:
+        time.sleep(0.1)
+        # no capture thread
+        assert screen.n_frames == 0 and not screen.thread.is_alive()
+        screen.poll()
+        seq, frame = screen.latest()
+        assert seq == 1 and frame.shape == (32, 32, 3)
+        assert backend.threads == {threading.get_ident()}
+    finally:
+        screen.stop()
+
+
+class FakeShot:
+    def __init__(self, monitor):
+        self.width, self.height = monitor['width'], monitor['height']
+        bgra = np.zeros((self.height, self.width, 4), dtype=np.uint8)
+        bgra[:, :, 2] = 200  # red
+        self.raw = bgra.tobytes()
+
+
+def test_mss_grab_on_high_dpi_screens(monkeypatch):
+    pytest.importorskip('cv2')
+
+    monitors = []
+
+    def grab(monitor):
+        monitors.append(monitor)
+        return FakeShot(monitor)
+
+    monkeypatch.setattr(capture, 'mss', SimpleNamespace(mss=lambda: SimpleNamespace(grab=grab, close=lambda: None)))
+    monkeypatch.setattr(capture.sys, 'platform', 'linux')
+    screen = capture.ScreenCapture(backend='mss')
+    # logical region on a screen with 2 physical pixels per logical pixel
+    screen.set_region((10, 20, 64, 48), pixel_ratio=2.)
+    screen.backend.open()
+    screen._grab()
+    screen.backend.close()
+
+    assert monitors == [{'left': 20, 'top': 40, 'width': 128, 'height': 96}]
+    seq, frame = screen.latest()
+    assert frame.shape == (48, 64, 3)
+    assert (frame == (200, 0, 0)).all()
@@ -0,0 +1,84 @@
+"""Tests of the in-memory image conversions."""
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('PySide6')
+
+from PIL import Image
+from PySide6.QtGui import QColor, QImage
+from PySide6.QtWidgets import QApplication
+
+import imaging
+
+
+def random_image(h, w, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, (h, w, 3), dtype=np.uint8)
+
+
+@pytest.mark.parametrize('w', [1, 3, 5, 64, 65])
+def test_array_qimage_round_trip(w):
+    # odd widths: RGB888 lines are padded to 4 bytes
+    arr = random_image(7, w)
+    qimage = imaging.array_to_qimage(arr)
+    assert (qimage.width(), qimage.height()) == (w, 7)
+    assert np.array_equal(imaging.qimage_to_array(qimage), arr)
+
+
+def test_array_to_qimage_non_contiguous():
+    arr = random_image(16, 16)
+    view = arr[::2, 1::3]
+    assert np.array_equal(imaging.qimage_to_array(imaging.array_to_qimage(view)), view)
+
+
+@pytest.mark.parametrize('fmt', [QImage.Format_RGB32, QImage.Format_ARGB32, QImage.Format_ARGB32_Premultiplied,
+                                 QImage.Format_RGBX8888, QImage.Format_RGBA8888, QImage.Format_RGB888])
+def test_qimage_formats(fmt):
+    qimage = QImage(5, 3, fmt)
+    qimage.fill(QColor(10, 20, 30))
+    qimage.setPixelColor(4, 2, QColor(200, 100, 50))
+
+    arr = imaging.qimage_to_array(qimage)
+    assert arr.shape == (3, 5, 3)
+    assert tuple(arr[0, 0]) == (10, 20, 30)
+    assert tuple(arr[2, 4]) == (200, 100, 50)
+
+
+def test_pil_round_trip():
+    # pixmaps need an application
+    app = QApplication.instance() or QApplication([])
+
+    arr = random_image(9, 11)
+    pil = imaging.qimage_to_pil(imaging.array_to_qimage(arr))
+    assert pil.mode == 'RGB' and pil.size == (11, 9)
+    assert np.array_equal(np.asarray(pil), arr)
+
+    pixmap = imaging.pil_to_qpixmap(Image.fromarray(arr).convert('RGBA'))
+    assert np.array_equal(imaging.qimage_to_array(pixmap.toImage()), arr)
+
+
+def test_frame_change_detector():
+    detector = imaging.FrameChangeDetector(threshold=2.)
+    frame = np.full((64, 64, 3), 100, dtype=np.uint8)
+    assert detector.has_changed(frame)
+    detector.set_reference(frame)
+    assert not detector.has_changed(frame)
+
+    # noise below the threshold
+    noisy = (frame.astype(int) + np.random.default_rng(0).integers(-3, 4, frame.shape)).astype(np.uint8)
+    assert not detector.has_changed(noisy)
+    assert detector.last_difference < 2.
+
+    # uniform shift: exactly at the threshold is not a change, above is
+    assert not detector.has_changed(frame + 2)
+    assert detector.has_changed(frame + 3)
+
+    # a small but strong local change
+    edited = frame.copy()
+    edited[:16, :16] = 255
+    assert detector.has_changed(Image.fromarray(edited))
+
+    # comparing does not move the reference
+    assert not detector.has_changed(frame)
+    detector.reset()
+    assert detector.has_changed(frame)
@@ -0,0 +1,267 @@
+"""Tests of the inference engine helpers (CPU, no download)."""
+
+import os
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('diffusers')
+
+import lcm
+
+
+class FakePipe:
+    """
+    Stands for a loaded pipeline: records its device
+    """
+    components = {}
+    unet = None
+
+    def __init__(self, model_id):
+        self.model_id = model_id
+        self.device = None
+
+    def to(self, device):
+        self.device = device
+        return self
+
+
+@pytest.fixture
+def built(monkeypatch):
+    built = []
+
+    def build_pipeline(model_id, use_ip, **kwargs):
+        built.append(model_id)
+        return FakePipe(model_id)
+
+    monkeypatch.setattr(lcm, 'build_pipeline', build_pipeline)
+    # no modules to tune in the fake pipelines
+    monkeypatch.setattr(lcm, 'tune_for_cpu', lambda pipe, compile_unet=False: None)
+    return built
+
+
+def test_pipeline_manager_lru(built):
+    manager = lcm.PipelineManager(max_loaded=2, max_on_device=1)
+    a = manager.get('model-a', False)
+    b = manager.get('model-b', False)
+    assert built == ['model-a', 'model-b']
+    # a single pipeline on the device: model-a was moved out
+    assert manager.on_device == {manager.make_key('model-b', False)}
+
+    # cached: moved back, not loaded again
+    assert manager.get('model-a', False) is a
+    assert built == ['model-a', 'model-b']
+    assert manager.on_device == {manager.make_key('model-a', False)}
+
+    # model-b is the least recently used one, it is discarded
+    manager.get('model-c', False)
+    assert built == ['model-a', 'model-b', 'model-c']
+    assert list(manager.pipes) == [manager.make_key('model-a', False), manager.make_key('model-c', False)]
+    assert manager.get('model-b', False) is not b
+
+
+class FakeIPPipe:
+    """
+    Counts the runs of the image encoder
+    """
+    image_encoder = SimpleNamespace(dtype=torch.float32)
+
+    def __init__(self):
+        self.n_encoded = 0
+
+    def prepare_ip_adapter_image_embeds(self, ip_adapter_image, **kwargs):
+        self.n_encoded += 1
+        return [torch.full((2, 1, 4), float(ip_adapter_image.getpixel((0, 0))[0]))]
+
+
+def test_ip_embed_cache(tmp_path):
+    from PIL import Image
+
+    ref = tmp_path / 'ref.png'
+    Image.new('RGB', (8, 8), (10, 0, 0)).save(ref)
+    pipe = FakeIPPipe()
+    cache = lcm.IPEmbedCache(folder=str(tmp_path / 'embeds'))
+    model_id = 'runwayml/stable-diffusion-v1-5'
+
+    embeds = cache.get(pipe, str(ref), model_id, 'cpu')
+    assert pipe.n_encoded == 1
+    assert cache.get(pipe, str(ref), model_id, 'cpu') is embeds
+    assert pipe.n_encoded == 1
+
+    # persisted: a new session reads the embeddings from the disk
+    cache = lcm.IPEmbedCache(folder=str(tmp_path / 'embeds'))
+    assert torch.equal(cache.get(pipe, str(ref), model_id, 'cpu')[0], embeds[0])
+    assert pipe.n_encoded == 1
+
+    # other model family: other image encoder
+    cache.get(pipe, str(ref), 'stabilityai/stable-diffusion-xl-base-1.0', 'cpu')
+    assert pipe.n_encoded == 2
+
+    # the key is the content of the image, not its path
+    Image.new('RGB', (8, 8), (20, 0, 0)).save(ref)
+    os.utime(ref, (0, 0))
+    assert cache.get(pipe, str(ref), model_id, 'cpu')[0][0, 0, 0] == 20
+    assert pipe.n_encoded == 3
+
+
+class FakeTextPipe:
+    """
+    Counts the runs of the text encoder
+    """
+    def __init__(self):
+        self.encoded = []
+
+    def encode_prompt(self, prompt, negative_prompt, **kwargs):
+        self.encoded.append(prompt)
+        return torch.zeros(1, 77, 8), torch.zeros(1, 77, 8)
+
+
+def test_prompt_embed_cache():
+    pipe = FakeTextPipe()
+    cache = lcm.PromptEmbedCache(max_size=2)
+
+    embeds = cache.get(pipe, 'a house', '', 'model', 'cpu')
+    assert set(embeds) == {'prompt_embeds', 'negative_prompt_embeds'}
+    assert cache.get(pipe, 'a house', '', 'model', 'cpu') is embeds
+    assert pipe.encoded == ['a house']
+    assert cache.hit_rate == 0.5
+
+    # every part of the key counts
+    cache.get(pipe, 'a house', 'blurry', 'model', 'cpu')
+    cache.get(pipe, 'a house', '', 'model', 'cpu', clip_skip=2)
+    assert len(pipe.encoded) == 3
+
+    # bounded: the least recently used prompt was dropped
+    assert len(cache.embeds) == 2
+    cache.get(pipe, 'a house', '', 'model', 'cpu')
+    assert len(pipe.encoded) == 4
+
+
+@pytest.fixture
+def tiny_infer(monkeypatch):
+    monkeypatch.setattr(lcm, 'get_device', lambda: 'cpu')
+    return lcm.make_infer(lcm.build_tiny_pipeline(), 'runwayml/stable-diffusion-v1-5', use_ip=False)
+
+
+def test_variants_are_batched(tiny_infer):
+    from PIL import Image
+    import numpy as np
+
+    image = Image.new('RGB', (64, 64), 'white')
+    out = tiny_infer(prompt='a house', negative_prompt='', image=image, num_variants=4, seed=7)
+    assert len(out) == 4
+    arrays = [np.asarray(im) for im in out]
+    assert all(a.shape == (64, 64, 3) for a in arrays)
+    # one seed per variant
+    assert all(not np.array_equal(arrays[i], arrays[j]) for i in range(4) for j in range(i + 1, 4))
+
+    # same seeds, same variants
+    again = tiny_infer(prompt='a house', negative_prompt='', image=image, num_variants=4, seeds=[7, 8, 9, 10])
+    assert all(np.array_equal(a, np.asarray(b)) for a, b in zip(arrays, again))
+
+    # variants with different strengths are batched per strength, in the requested order
+    mixed = tiny_infer(prompt='a house', negative_prompt='', image=image, num_variants=4, seeds=[7, 8, 9, 10],
+                       strengths=[0.9, 0.5, 0.9, 0.5])
+    assert len(mixed) == 4
+    assert np.array_equal(np.asarray(mixed[0]), arrays[0])
+    assert np.array_equal(np.asarray(mixed[2]), arrays[2])
+
+
+def test_video_recorder(tmp_path):
+    pytest.importorskip('cv2')
+    from PIL import Image
+
+    recorder = lcm.VideoRecorder(str(tmp_path / 'video.mp4'), png_folder=str(tmp_path))
+    for i in range(5):
+        recorder.add_frame(Image.new('RGB', (64, 48), (i * 50, 0, 0)))
+    assert recorder.stop() is None
+    assert recorder.n_frames + recorder.n_dropped == 5
+    assert (tmp_path / 'video.mp4').exists()
+    assert (tmp_path / 'frame_0001.png').exists()
+
+
+def test_video_recorder_failure_does_not_block(tmp_path):
+    pytest.importorskip('cv2')
+    from PIL import Image
+
+    # PNG frames cannot be written: the encoder thread stops at the first frame
+    recorder = lcm.VideoRecorder(str(tmp_path / 'video.mp4'), png_folder=str(tmp_path / 'missing'), max_queue=4)
+    for _ in range(20):
+        recorder.add_frame(Image.new('RGB', (64, 48)))
+    recorder.thread.join(timeout=10)
+    for _ in range(20):
+        recorder.add_frame(Image.new('RGB', (64, 48)))
+
+    assert isinstance(recorder.stop(), OSError)
+    assert not recorder.thread.is_alive()
+    assert recorder.n_frames == 1
+
+
+def test_stream_is_reset_by_other_requests(tiny_infer):
+    from PIL import Image
+
+    def push(stream=True):
+        return tiny_infer(prompt='a house', negative_prompt='', image=Image.new('RGB', (64, 64), 'white'),
+                          num_inference_steps=4, strength=0.5, seed=1, stream=stream)
+
+    # 2 denoising steps: one frame in flight before the first output
+    assert push() is None
+    assert push() is not None
+    assert push() is not None
+
+    # a full request in between: the next stream starts again from an empty batch
+    assert push(stream=False) is not None
+    assert push() is None
+
+
+def fake_ip_pipe(n_processors=3):
+    processors = {f'attn{i}': SimpleNamespace(to_k_ip=None, scale=[1.]) for i in range(n_processors)}
+    return SimpleNamespace(unet=SimpleNamespace(attn_processors=processors))
+
+
+def test_ip_scale_is_updated_in_place():
+    pipe = fake_ip_pipe()
+    lcm.set_ip_scale(pipe, 1.)
+    tensors = [p.scale[0] for p in pipe.unet.attn_processors.values()]
+    assert all(torch.is_tensor(t) for t in tensors)
+
+    with torch.inference_mode():
+        lcm.set_ip_scale(pipe, 0.4)
+    # same tensors: a compiled graph reading them does not have to be compiled again
+    assert [p.scale[0] for p in pipe.unet.attn_processors.values()] == tensors
+    assert all(abs(t.item() - 0.4) < 1e-6 for t in tensors)
+
+
+def test_tiled_vae_does_not_modify_the_shared_vae():
+    pipe = lcm.build_tiny_pipeline()
+    tiled = lcm.tiled_vae(pipe.vae)
+    assert tiled.use_tiling and not pipe.vae.use_tiling
+    assert tiled.encoder is pipe.vae.encoder
+
+
+def test_eviction_waits_for_warm_ups(monkeypatch):
+    monkeypatch.setattr(lcm, 'build_pipeline', lambda model_id, use_ip, device=None: lcm.build_tiny_pipeline())
+    manager = lcm.PipelineManager(max_loaded=1, max_on_device=1)
+    manager._device = 'cpu'
+    manager.get('model-a', False)
+    key_a = manager.make_key('model-a', False)
+
+    # a warm-up is using model-a
+    with manager.lock:
+        manager.pins[key_a] += 1
+
+    loader = threading.Thread(target=manager.get, args=('model-b', False))
+    loader.start()
+    loader.join(timeout=2)
+    assert loader.is_alive()
+    assert manager.is_loaded('model-a', False)
+
+    with manager.lock:
+        manager.pins[key_a] -= 1
+        manager.unpinned.notify_all()
+    loader.join(timeout=30)
+    assert not loader.is_alive()
+    assert not manager.is_loaded('model-a', False)
+    assert manager.is_loaded('model-b', False)
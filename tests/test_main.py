@@ -0,0 +1,162 @@
+"""Offscreen smoke test of the main window, on a tiny random-weight pipeline (CPU, no download)."""
+
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('PySide6')
+pytest.importorskip('torch')
+pytest.importorskip('diffusers')
+pytest.importorskip('cv2')
+
+from PySide6.QtCore import QEvent, QPoint, QPointF, Qt
+from PySide6.QtGui import QMouseEvent
+from PySide6.QtWidgets import QApplication
+
+import lcm
+import metrics
+import server
+
+
+class TinyPipelineManager(lcm.PipelineManager):
+    """
+    Serves the tiny pipeline (and a random-weight tiny autoencoder) for every model
+    """
+    def get_infer(self, model_id, use_ip, ip_ref_img=None):
+        tiny_vae = lcm.get_tiny_vae(model_id, 'cpu', random_weights=True)
+        return lcm.make_infer(self.get(model_id, use_ip), model_id, use_ip=False, prompt_cache=self.prompt_cache,
+                              tiny_vae=tiny_vae)
+
+
+def mouse(kind, pos, button=Qt.LeftButton, buttons=Qt.LeftButton):
+    return QMouseEvent(kind, QPointF(pos), QPointF(pos), button, buttons, Qt.NoModifier)
+
+
+def wait_for(app, condition, timeout=30.):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        app.processEvents()
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.fixture
+def window(monkeypatch):
+    app = QApplication.instance() or QApplication([])
+
+    monkeypatch.setattr(lcm, 'get_device', lambda: 'cpu')
+    monkeypatch.setattr(lcm, 'build_pipeline', lambda model_id, use_ip, **kwargs: lcm.build_tiny_pipeline())
+    import main
+    monkeypatch.setattr(main, 'PipelineManager', TinyPipelineManager)
+    win = main.PaintLCM(False)
+    win.show()
+    # the model is loaded in the background
+    assert wait_for(app, lambda: win.infer is not None)
+    yield app, win
+    win.close()
+
+
+def test_strokes_are_streamed(window):
+    app, win = window
+    win.checkBox.setChecked(True)  # live update
+    n_submitted = win.worker.n_submitted
+
+    dirty = []
+    win.canvas.canvasDirty.connect(lambda: dirty.append(1))
+    canvas = win.canvas
+    canvas.mousePressEvent(mouse(QEvent.MouseButtonPress, QPoint(10, 10)))
+    for x in range(20, 200, 20):
+        canvas.mouseMoveEvent(mouse(QEvent.MouseMove, QPoint(x, x), button=Qt.NoButton))
+    assert len(dirty) == 9
+    # inferences are requested while the stroke is in progress
+    assert wait_for(app, lambda: win.worker.n_submitted > n_submitted)
+    canvas.mouseReleaseEvent(mouse(QEvent.MouseButtonRelease, QPoint(200, 200), buttons=Qt.NoButton))
+    assert len(canvas.strokes) == 1
+
+
+def test_variant_promotion(window):
+    app, win = window
+    win.variants_action.setChecked(True)
+    win.update_image()
+    assert wait_for(app, lambda: len(win.variants) == win.n_variants)
+    assert len(win.result_canvas._variants) == win.n_variants
+
+    # the chosen variant becomes the output, its seed is kept
+    seeds = list(win.variant_seeds)
+    win.result_canvas.variantSelected.emit(2)
+    assert win.out is win.variants[2]
+    assert win.seed == seeds[2]
+    assert not win.variants_action.isChecked()
+    assert win.result_canvas._variants == []
+
+
+def test_export_runs_in_background(window, tmp_path, monkeypatch):
+    import main
+
+    app, win = window
+    win.fast_vae_action.setChecked(True)
+    win.update_image()
+    assert wait_for(app, lambda: win.last_request is not None and win.last_request['fast_vae'])
+
+    file_path = tmp_path / 'out.png'
+    monkeypatch.setattr(main.QFileDialog, 'getSaveFileName', lambda *args: (str(file_path), ''))
+    saved = []
+    win.exporter.taskDone.connect(lambda path, out: saved.append(path))
+    win.save_output()
+    assert win.statusbar.currentMessage().startswith('exporting')
+
+    # the full VAE output is computed by the exporter thread, the file is written by the window
+    assert wait_for(app, lambda: saved)
+    assert saved == [str(file_path)]
+    assert file_path.exists()
+    assert win.statusbar.currentMessage() == f'result saved: {file_path}'
+
+
+def test_preimage_runs_in_background(window):
+    app, win = window
+    # the tiny pipeline has no IP adapter: the model is requested again without it
+    win.checkBox_ip.setChecked(False)
+    win.change_inference_model()
+    assert wait_for(app, lambda: win.loading_bar.isHidden())
+
+    done = []
+    win.preimager.taskDone.connect(lambda key, im: done.append(im.size))
+    win.generate_preimage()
+    # the button is disabled until the image is shown
+    assert not win.pushButton_preimg.isEnabled()
+    assert wait_for(app, lambda: done and win.pushButton_preimg.isEnabled())
+    # text-to-image with the components of the loaded (tiny) pipeline
+    assert done == [(256, 256)]
+
+
+@pytest.fixture
+def thin_client(tmp_path, monkeypatch):
+    app = QApplication.instance() or QApplication([])
+
+    monkeypatch.setenv('FOCUSPOCUS_AUTHKEY', 'test')
+    address = str(tmp_path / 'focuspocus.sock')
+    inference_server = server.InferenceServer(server.StubPipelineManager(), address)
+    threading.Thread(target=inference_server.serve_forever, daemon=True).start()
+    assert wait_for(app, lambda: os.path.exists(address), timeout=5)
+    monkeypatch.setenv('FOCUSPOCUS_SERVER', address)
+
+    import main
+    win = main.PaintLCM(False)
+    win.show()
+    assert wait_for(app, lambda: win.infer is not None)
+    yield app, win
+    win.close()
+    inference_server.close()
+
+
+def test_thin_client_latency(thin_client, monkeypatch):
+    app, win = thin_client
+    monkeypatch.setattr(metrics, 'registry', metrics.MetricsRegistry())
+    win.out = None
+    win.update_image()
+    assert wait_for(app, lambda: win.out is not None)
+    # the inference histogram (HUD, stroke throttle) is filled by the worker with the round trip times
+    assert win.worker.infer.remote
+    assert metrics.registry.histogram('inference')['count'] >= 1
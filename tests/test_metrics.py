@@ -0,0 +1,32 @@
+"""Tests of the metrics registry."""
+
+import json
+
+import metrics
+
+
+def test_histogram_summary():
+    reg = metrics.MetricsRegistry(histogram_size=10)
+    for v in range(20):
+        reg.observe('inference', v)
+    summary = reg.histogram('inference')
+    # the window keeps the last 10 values, the count is for the whole session
+    assert summary['count'] == 20
+    assert summary['mean'] == 14.5
+    assert summary['p50'] == 15
+    assert summary['p95'] == 19
+    assert reg.histogram('unknown')['p50'] == 0.
+
+
+def test_snapshots_are_bounded(tmp_path):
+    reg = metrics.MetricsRegistry(max_snapshots=3)
+    for i in range(5):
+        reg.increment('dropped_frames')
+        reg.snapshot()
+    assert [s['counter.dropped_frames'] for s in reg.snapshots] == [3, 4, 5]
+
+    reg.export(str(tmp_path / 'metrics.json'))
+    with open(tmp_path / 'metrics.json') as f:
+        data = json.load(f)
+    assert len(data['snapshots']) == 3
+    assert data['final']['counters'] == {'dropped_frames': 5}
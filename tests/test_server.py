@@ -0,0 +1,103 @@
+"""Tests of the inference server transport, with the stub pipeline (no model)."""
+
+import os
+import stat
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('diffusers')
+
+import server
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.delenv('FOCUSPOCUS_AUTHKEY', raising=False)
+    return tmp_path
+
+
+def test_auth_key_is_private(home):
+    key = server.auth_key()
+    assert len(key) == 64
+    assert server.auth_key() == key
+
+    folder = home / '.focuspocus'
+    if os.name == 'posix':
+        assert stat.S_IMODE(os.stat(folder).st_mode) == 0o700
+        assert stat.S_IMODE(os.stat(folder / 'authkey').st_mode) == 0o600
+
+
+def test_only_loopback_addresses():
+    assert server.parse_address('localhost:5000') == ('localhost', 5000)
+    assert server.parse_address('127.0.0.1:5000') == ('127.0.0.1', 5000)
+    for address in ('0.0.0.0:5000', '8.8.8.8:5000'):
+        with pytest.raises(ValueError):
+            server.parse_address(address)
+
+
+@pytest.mark.skipif(os.name != 'posix', reason="Unix socket")
+def test_default_socket_round_trip(home):
+    inference_server = server.InferenceServer(server.StubPipelineManager())
+    threading.Thread(target=inference_server.serve_forever, daemon=True).start()
+    deadline = time.time() + 5
+    while not os.path.exists(inference_server.address) and time.time() < deadline:
+        time.sleep(0.01)
+    try:
+        assert stat.S_IMODE(os.stat(inference_server.address).st_mode) == 0o600
+        client = server.InferenceClient()
+        assert not client.is_loaded('model', False)
+        client.load('model', False)
+        assert client.is_loaded('model', False)
+        client.disconnect()
+    finally:
+        inference_server.close()
+
+
+def test_tcp_round_trip(home):
+    from PIL import Image
+
+    # the parsed address is given to the server: it is not parsed again
+    inference_server = server.InferenceServer(server.StubPipelineManager(), server.parse_address('127.0.0.1:0'))
+    threading.Thread(target=inference_server.serve_forever, daemon=True).start()
+    deadline = time.time() + 5
+    while inference_server.listener is None and time.time() < deadline:
+        time.sleep(0.01)
+    try:
+        # port 0: the system chose a free port
+        client = server.InferenceClient(inference_server.listener.address)
+        infer = client.get_infer('model', False)
+        assert infer.remote
+        image = Image.new('RGB', (64, 48), (200, 100, 50))
+        out = infer(prompt='a house', negative_prompt='', image=image, strength=0.5, seed=1)
+        assert out.size == (64, 48)
+        variants = infer(prompt='a house', negative_prompt='', image=image, strength=0.5, seed=1, num_variants=2)
+        assert [im.size for im in variants] == [(64, 48)] * 2
+        client.disconnect()
+    finally:
+        inference_server.close()
+
+
+def test_batch_through_the_server(home, tmp_path):
+    from PIL import Image
+
+    import batch
+
+    inference_server = server.InferenceServer(server.StubPipelineManager(), ('127.0.0.1', 0))
+    threading.Thread(target=inference_server.serve_forever, daemon=True).start()
+    deadline = time.time() + 5
+    while inference_server.listener is None and time.time() < deadline:
+        time.sleep(0.01)
+    try:
+        inputs = tmp_path / 'inputs'
+        inputs.mkdir()
+        for i in range(3):
+            Image.new('RGB', (64, 64), (i * 80, 0, 0)).save(inputs / f'{i}.png')
+        host, port = inference_server.listener.address
+        assert batch.main([str(inputs), '-o', str(tmp_path / 'out'), '--server', f'{host}:{port}']) == 0
+        assert len(os.listdir(tmp_path / 'out')) == 3
+    finally:
+        inference_server.close()
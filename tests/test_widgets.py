@@ -0,0 +1,93 @@
+"""Offscreen smoke tests of the canvas widgets."""
+
+import pytest
+
+pytest.importorskip('PySide6')
+
+from PySide6.QtCore import QEvent, QPoint, QPointF, Qt
+from PySide6.QtGui import QColor, QImage, QMouseEvent, QPixmap
+from PySide6.QtWidgets import QApplication
+
+import imaging
+import widgets as wid
+
+
+@pytest.fixture(scope='module')
+def app():
+    return QApplication.instance() or QApplication([])
+
+
+def mouse(kind, pos, button=Qt.LeftButton, buttons=Qt.LeftButton):
+    return QMouseEvent(kind, QPointF(pos), QPointF(pos), button, buttons, Qt.NoModifier)
+
+
+def stroke(canvas, points):
+    canvas.mousePressEvent(mouse(QEvent.MouseButtonPress, points[0]))
+    for p in points[1:]:
+        canvas.mouseMoveEvent(mouse(QEvent.MouseMove, p, button=Qt.NoButton))
+    canvas.mouseReleaseEvent(mouse(QEvent.MouseButtonRelease, points[-1], buttons=Qt.NoButton))
+
+
+def pixel(canvas, x, y):
+    return QColor(imaging.render_view(canvas).pixel(x, y))
+
+
+def test_canvas_strokes_are_rasterized(app):
+    canvas = wid.Canvas((128, 128))
+    canvas.show()
+    assert canvas.strokes == [] and canvas.current_stroke == []
+
+    stroke(canvas, [QPoint(10, 64), QPoint(60, 64), QPoint(110, 64)])
+    assert len(canvas.strokes) == 1
+    # one layer item, no item per segment
+    assert len(canvas.scene.items()) == 2
+    assert pixel(canvas, 60, 64) == QColor(Qt.black)
+
+    canvas.set_tool('rectangle')
+    stroke(canvas, [QPoint(20, 90), QPoint(50, 120)])
+    assert len(canvas.strokes) == 2
+    assert canvas.temp_item is None
+    assert len(canvas.scene.items()) == 2
+
+    canvas.undo()
+    assert len(canvas.strokes) == 1
+    assert pixel(canvas, 60, 64) == QColor(Qt.black)
+
+    canvas.clear_drawing()
+    assert canvas.strokes == []
+    assert pixel(canvas, 60, 64) != QColor(Qt.black)
+
+
+def test_canvas_new_scene(app):
+    canvas = wid.Canvas((128, 128))
+    canvas.create_new_scene(256, 192)
+    assert (canvas.layer.image.width(), canvas.layer.image.height()) == (256, 192)
+    canvas.draw_rectangle(QPointF(0, 0), QPointF(100, 100))
+    canvas.setPhoto(QPixmap(256, 192))
+
+
+def test_result_canvas_variants(app):
+    result = wid.simpleCanvas((128, 128))
+    result.show()
+    selected = []
+    result.variantSelected.connect(selected.append)
+
+    pixmaps = []
+    for color in (Qt.red, Qt.green, Qt.blue, Qt.yellow):
+        image = QImage(64, 64, QImage.Format_RGB32)
+        image.fill(color)
+        pixmaps.append(QPixmap.fromImage(image))
+    result.setVariants(pixmaps)
+    result.mousePressEvent(mouse(QEvent.MouseButtonPress, QPoint(100, 100)))
+    assert selected == [3]
+
+    result.setPhoto(pixmaps[0])
+    assert result._variants == []
+
+
+def test_transparent_box_drag(app):
+    box = wid.TransparentBox((128, 128))
+    box.mousePressEvent(mouse(QEvent.MouseButtonPress, QPoint(5, 5)))
+    assert box.dragging
+    box.mouseReleaseEvent(mouse(QEvent.MouseButtonRelease, QPoint(5, 5), buttons=Qt.NoButton))
+    assert not box.dragging
@@ -0,0 +1,86 @@
+"""Tests of the worker helpers."""
+
+import time
+
+import pytest
+
+pytest.importorskip('PySide6')
+
+import workers as wk
+
+
+def test_quality_levels_follow_the_latency():
+    quality = wk.QualityController(target_fps=4., window=3)
+    assert quality.apply(8, (512, 512)) == (8, (512, 512))
+
+    # over budget: steps first
+    quality.update(0.5)
+    assert quality.level == 1
+    assert quality.apply(8, (512, 512)) == (6, (512, 512))
+    # the new level is measured before changing again
+    quality.update(0.5)
+    quality.update(0.5)
+    assert quality.level == 1
+    quality.update(0.5)
+    assert quality.level == 2
+
+    # under budget: back to full quality, one level at a time
+    for _ in range(20):
+        quality.update(0.05)
+    assert quality.level == 0
+    assert not quality.is_degraded()
+
+
+def test_quality_keeps_one_denoising_step():
+    quality = wk.QualityController()
+    quality.level = len(quality.levels) - 1
+    steps, size = quality.apply(4, (512, 512), strength=0.5)
+    assert int(steps * 0.5) >= 1
+    assert size == (256, 256)
+
+
+def test_failed_inferences_count_as_over_budget():
+    quality = wk.QualityController(target_fps=4., window=3)
+    quality.update_failed()
+    assert quality.level == 1
+
+
+def test_remote_inference_latency_is_recorded(monkeypatch):
+    from PySide6.QtCore import QCoreApplication
+
+    import metrics
+
+    app = QCoreApplication.instance() or QCoreApplication([])
+    monkeypatch.setattr(metrics, 'registry', metrics.MetricsRegistry())
+
+    def local(**request):
+        return request['image']
+
+    def remote(**request):
+        return request['image']
+    remote.remote = True
+
+    def wait_results(n, timeout=10.):
+        deadline = time.time() + timeout
+        while len(results) < n and time.time() < deadline:
+            app.processEvents()
+            time.sleep(0.01)
+        return len(results) == n
+
+    worker = wk.InferenceWorker(local)
+    results = []
+    worker.resultReady.connect(lambda out, request, context: results.append(context['latency']))
+    worker.start()
+    try:
+        # local inferences are timed by the engine itself
+        worker.submit({'image': 1})
+        assert wait_results(1)
+        assert metrics.registry.histogram('inference')['count'] == 0
+
+        # the engine of a remote inference runs in the server process: the worker records the round trip
+        worker.set_infer(remote)
+        worker.submit({'image': 2})
+        assert wait_results(2)
+        assert metrics.registry.histogram('inference')['count'] == 1
+    finally:
+        worker.stop()
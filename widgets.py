@@ -1,4 +1,6 @@
 # standard libraries
+import math
+
 from PySide6.QtCore import *
 from PySide6.QtGui import *
 from PySide6.QtWidgets import *
@@ -151,10 +153,13 @@ class TransparentBox(QWidget):
 
 
 class simpleCanvas(QGraphicsView):
+    variantSelected = Signal(int)
+
     def __init__(self, img_size):
         super().__init__()
 
         self.w, self.h = img_size
+        self._variants = []
 
         self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
@@ -184,6 +189,7 @@ class simpleCanvas(QGraphicsView):
         self.setMinimumSize(w, h)
         self.setMaximumSize(w, h)
         self.resetTransform()
+        self._variants = []
         self.add_empty_photo()
         self.update()
 
@@ -191,8 +197,43 @@ class simpleCanvas(QGraphicsView):
         self._photo = QGraphicsPixmapItem()
         self.scene.addItem(self._photo)
 
+    def setVariants(self, pixmaps):
+        """
+        Shows several images as a grid. Clicking an image emits variantSelected with its index
+        """
+        self.clear_variants()
+
+        n = len(pixmaps)
+        cols = math.ceil(math.sqrt(n))
+        rows = math.ceil(n / cols)
+        cell_w, cell_h = self.w // cols, self.h // rows
+
+        for i, pixmap in enumerate(pixmaps):
+            item = QGraphicsPixmapItem(pixmap.scaled(QSize(cell_w, cell_h), Qt.IgnoreAspectRatio,
+                                                     Qt.SmoothTransformation))
+            item.setPos((i % cols) * cell_w, (i // cols) * cell_h)
+            self.scene.addItem(item)
+            self._variants.append(item)
+
+        self._photo.hide()
+
+    def clear_variants(self):
+        for item in self._variants:
+            self.scene.removeItem(item)
+        self._variants = []
+        self._photo.show()
+
+    def mousePressEvent(self, event):
+        if self._variants and event.button() == Qt.LeftButton:
+            item = self.itemAt(event.pos())
+            if item in self._variants:
+                self.variantSelected.emit(self._variants.index(item))
+        super().mousePressEvent(event)
+
     def setPhoto(self, pixmap=None):
         if pixmap and not pixmap.isNull():
+            self.clear_variants()
+
             # Get the size of the sceneRect
             targetSize = QSize(self.w, self.h)
 
@@ -203,8 +244,58 @@ class simpleCanvas(QGraphicsView):
             self._photo.setPixmap(scaledPixmap)
 
 
+class StrokeLayer(QGraphicsItem):
+    """
+    Transparent image holding the rasterized strokes, shown as a single item of the scene.
+    Drawing only repaints the touched region, whatever the number of strokes
+    """
+    def __init__(self, w, h):
+        super().__init__()
+        self.image = QImage(w, h, QImage.Format_ARGB32_Premultiplied)
+        self.image.fill(Qt.transparent)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        return QRectF(0, 0, self.image.width(), self.image.height())
+
+    def paint(self, painter, option, widget=None):
+        rect = option.exposedRect
+        painter.drawImage(rect, self.image, rect)
+
+    def begin(self):
+        painter = QPainter(self.image)
+        painter.setRenderHint(QPainter.Antialiasing)
+        return painter
+
+    def draw_line(self, p1, p2, pen):
+        painter = self.begin()
+        painter.setPen(pen)
+        painter.drawLine(p1, p2)
+        painter.end()
+
+        margin = pen.widthF() / 2 + 2
+        self.update(QRectF(p1, p2).normalized().adjusted(-margin, -margin, margin, margin))
+
+    def draw_shape(self, kind, rect, color):
+        rect = rect.normalized()
+        painter = self.begin()
+        painter.setBrush(QBrush(color))
+        if kind == 'ellipse':
+            painter.drawEllipse(rect)
+        else:
+            painter.drawRect(rect)
+        painter.end()
+
+        self.update(rect.adjusted(-2, -2, 2, 2))
+
+    def clear(self):
+        self.image.fill(Qt.transparent)
+        self.update()
+
+
 class Canvas(QGraphicsView):
     endDrawing = Signal()
+    canvasDirty = Signal()  # the drawing changed while the mouse button is still down
 
     def __init__(self, img_size):
         super().__init__()
@@ -223,6 +314,11 @@ class Canvas(QGraphicsView):
         self._photo = QGraphicsPixmapItem()
         self.scene.addItem(self._photo)
 
+        # strokes are rasterized in a layer above the photo, and recorded as vectors for undo
+        self.add_stroke_layer()
+        self.strokes = []
+        self.current_stroke = []
+
         self.current_tool = 'brush'
         self.current_color = QColor(Qt.black)
         self.brush_size = 10
@@ -241,6 +337,8 @@ class Canvas(QGraphicsView):
         self.setRenderHint(QPainter.Antialiasing)
 
     def create_new_scene(self, w, h):
+        self.w = w
+        self.h = h
         self.scene.clear()
         self.scene = QGraphicsScene()
         self.setScene(self.scene)
@@ -249,12 +347,21 @@ class Canvas(QGraphicsView):
         self.setMaximumSize(w, h)
         self.resetTransform()
         self.add_empty_photo()
+        self.add_stroke_layer()
+        self.strokes = []
+        self.current_stroke = []
+        self.temp_item = None
         self.update()
 
     def add_empty_photo(self):
         self._photo = QGraphicsPixmapItem()
         self.scene.addItem(self._photo)
 
+    def add_stroke_layer(self):
+        self.layer = StrokeLayer(self.w, self.h)
+        self.layer.setZValue(1)
+        self.scene.addItem(self.layer)
+
     def setPhoto(self, pixmap=None):
         if pixmap and not pixmap.isNull():
             self._photo.setPixmap(pixmap)
@@ -300,7 +407,9 @@ class Canvas(QGraphicsView):
                     self.temp_item = QGraphicsRectItem(QRectF(self.start_point, self.start_point))
 
                 if self.temp_item:
+                    # vector preview above the layer, rasterized when the mouse is released
                     self.temp_item.setBrush(QBrush(self.current_color))
+                    self.temp_item.setZValue(2)
                     self.scene.addItem(self.temp_item)
 
     def mouseMoveEvent(self, event):
@@ -313,8 +422,20 @@ class Canvas(QGraphicsView):
                     self.erase_line(event.pos())
             elif self.current_tool in ['ellipse', 'rectangle'] and self.temp_item:
                 self.update_temp_shape(end_point)
+            else:
+                return
+            self.canvasDirty.emit()
 
     def mouseReleaseEvent(self, event):
+        if event.button() == Qt.LeftButton and self.drawing:
+            # the shape being drawn is rasterized in the stroke layer
+            if self.temp_item:
+                rect = self.temp_item.rect()
+                self.scene.removeItem(self.temp_item)
+                self.add_shape(self.current_tool, rect, self.current_color)
+            if self.current_stroke:
+                self.strokes.append(self.current_stroke)
+                self.current_stroke = []
         self.endDrawing.emit()
         if event.button() == Qt.LeftButton and self.drawing:
             self.drawing = False
@@ -327,38 +448,56 @@ class Canvas(QGraphicsView):
         elif self.current_tool == 'rectangle':
             self.temp_item.setRect(rect)
 
+    def add_segment(self, p1, p2, color, width):
+        pen = QPen(color, width, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
+        self.layer.draw_line(p1, p2, pen)
+        self.current_stroke.append(('line', p1, p2, QColor(color), width))
+
+    def add_shape(self, kind, rect, color):
+        self.layer.draw_shape(kind, rect, color)
+        self.current_stroke.append((kind, QRectF(rect), QColor(color)))
+
     def draw_line(self, end_point):
-        path = QPainterPath(self.mapToScene(self.last_point))
-        path.lineTo(self.mapToScene(end_point))
-        pen = QPen(self.current_color, self.brush_size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
-        self.scene.addPath(path, pen)
+        self.add_segment(self.mapToScene(self.last_point), self.mapToScene(end_point), self.current_color,
+                         self.brush_size)
         self.last_point = end_point
 
     def erase_line(self, end_point):
-        eraser_path = QPainterPath(self.mapToScene(self.last_point))
-        eraser_path.lineTo(self.mapToScene(end_point))
-        eraser = QPen(Qt.white, self.brush_size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
-        self.scene.addPath(eraser_path, eraser)
+        self.add_segment(self.mapToScene(self.last_point), self.mapToScene(end_point), QColor(Qt.white),
+                         self.brush_size)
         self.last_point = end_point
 
     def draw_ellipse(self, start_point, end_point):
-        rect = QRectF(start_point, end_point)
-        ellipse = QGraphicsEllipseItem(rect)
-        ellipse.setBrush(QBrush(self.current_color))
-        self.scene.addItem(ellipse)
+        self.add_shape('ellipse', QRectF(start_point, end_point), self.current_color)
 
     def draw_rectangle(self, start_point, end_point):
-        rect = QRectF(start_point, end_point)
-        rectangle = QGraphicsRectItem(rect)
-        rectangle.setBrush(QBrush(self.current_color))
-        self.scene.addItem(rectangle)
+        self.add_shape('rectangle', QRectF(start_point, end_point), self.current_color)
+
+    def undo(self):
+        """
+        Removes the last stroke: the layer is repainted from the vector record
+        """
+        if not self.strokes:
+            return
+        self.strokes.pop()
+        self.layer.clear()
+        for stroke in self.strokes:
+            for op in stroke:
+                if op[0] == 'line':
+                    _, p1, p2, color, width = op
+                    self.layer.draw_line(p1, p2, QPen(color, width, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
+                else:
+                    kind, rect, color = op
+                    self.layer.draw_shape(kind, rect, color)
 
     def clear_drawing(self):
-        for item in self.scene.items():
-            if isinstance(item, QGraphicsPathItem) or \
-                    isinstance(item, QGraphicsEllipseItem) or \
-                    isinstance(item, QGraphicsRectItem):
-                self.scene.removeItem(item)
+        # O(1): the layer is simply cleared, no item to remove
+        if self.temp_item is not None:
+            self.scene.removeItem(self.temp_item)
+            self.temp_item = None
+        self.layer.clear()
+        self.strokes = []
+        self.current_stroke = []
 
     def wheelEvent(self, event):
         delta = event.angleDelta().y()
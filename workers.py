@@ -0,0 +1,336 @@
+import time
+from collections import deque
+
+from PySide6.QtCore import *
+
+import metrics
+
+
+class InferenceWorker(QThread):
+    """
+    Runs the diffusion pipeline outside of the GUI thread.
+
+    The worker only holds one pending request ('latest request wins'): when a new request is submitted while
+    another one is still waiting, the older one is dropped. Stale capture frames and intermediate slider positions
+    are therefore never computed, and the displayed output lags the input by at most one inference.
+    """
+    resultReady = Signal(object, object, object)  # (output image, request, context)
+    inferenceFailed = Signal(str, object)  # (error message, context)
+
+    def __init__(self, infer=None, parent=None):
+        super().__init__(parent)
+        self.infer = infer
+
+        self._mutex = QMutex()
+        self._condition = QWaitCondition()
+        self._pending = None
+        self._running = True
+
+        # counters
+        self.n_submitted = 0
+        self.n_dropped = 0
+        self.n_done = 0
+
+    def set_infer(self, infer):
+        """
+        Replace the inference function (e.g. after a model change)
+        """
+        with QMutexLocker(self._mutex):
+            self.infer = infer
+
+    def submit(self, request, context=None):
+        """
+        Queue an inference request, replacing the pending one if any
+        :param request: (dict) keyword arguments for the infer function
+        :param context: (dict) optional caller data, returned with the result. The inference latency (s) is added
+        under 'latency'
+        """
+        with QMutexLocker(self._mutex):
+            self.n_submitted += 1
+            if self._pending is not None:
+                self.n_dropped += 1
+                metrics.registry.increment('dropped_frames')
+            self._pending = (request, context if context is not None else {})
+            metrics.registry.set_gauge('queue_depth', 1)
+            self._condition.wakeOne()
+
+    def pending(self):
+        with QMutexLocker(self._mutex):
+            return self._pending is not None
+
+    def stop(self):
+        with QMutexLocker(self._mutex):
+            self._running = False
+            self._pending = None
+            self._condition.wakeAll()
+        self.wait()
+
+    @staticmethod
+    def _record_latency(infer, context, start):
+        context['latency'] = time.perf_counter() - start
+        if getattr(infer, 'remote', False):
+            # the engine timer runs in the inference server process, the round trip is recorded here
+            metrics.registry.observe('inference', context['latency'] * 1000)
+
+    def run(self):
+        while True:
+            self._mutex.lock()
+            while self._pending is None and self._running:
+                self._condition.wait(self._mutex)
+            if not self._running:
+                self._mutex.unlock()
+                break
+            request, context = self._pending
+            self._pending = None
+            infer = self.infer
+            metrics.registry.set_gauge('queue_depth', 0)
+            self._mutex.unlock()
+
+            if infer is None:
+                # no model loaded (yet), the request is lost
+                continue
+
+            try:
+                start = time.perf_counter()
+                out = infer(**request)
+                self._record_latency(infer, context, start)
+            except Exception as e:
+                self._record_latency(infer, context, start)
+                self.inferenceFailed.emit(str(e), context)
+                continue
+
+            if out is None:
+                # stream batching: the frame is still in flight, nothing to show yet
+                continue
+
+            self.n_done += 1
+            metrics.registry.mark('output')
+            self.resultReady.emit(out, request, context)
+
+
+class ModelLoader(QThread):
+    """
+    Loads (and warms up) pipelines outside of the GUI thread, so that the window stays responsive.
+    Like the inference worker, only the last requested model is kept when several are requested during a load.
+    """
+    modelLoaded = Signal(object, object)  # (infer function, (model_id, use_ip))
+    loadFailed = Signal(str)
+    progress = Signal(str)
+
+    def __init__(self, load, parent=None):
+        """
+        :param load: function (model_id, use_ip, progress) --> infer function, progress being a function(str)
+        """
+        super().__init__(parent)
+        self.load = load
+
+        self._mutex = QMutex()
+        self._condition = QWaitCondition()
+        self._pending = None
+        self._running = True
+
+    def request(self, model_id, use_ip):
+        with QMutexLocker(self._mutex):
+            self._pending = (model_id, use_ip)
+            self._condition.wakeOne()
+
+    def stop(self):
+        with QMutexLocker(self._mutex):
+            self._running = False
+            self._pending = None
+            self._condition.wakeAll()
+        self.wait()
+
+    def run(self):
+        while True:
+            self._mutex.lock()
+            while self._pending is None and self._running:
+                self._condition.wait(self._mutex)
+            if not self._running:
+                self._mutex.unlock()
+                break
+            key = self._pending
+            self._pending = None
+            self._mutex.unlock()
+
+            try:
+                infer = self.load(*key, progress=self.progress.emit)
+            except Exception as e:
+                self.loadFailed.emit(str(e))
+                continue
+
+            self.modelLoaded.emit(infer, key)
+
+
+class AdaptiveThrottle:
+    """
+    Rate limiter for live updates (e.g. while a stroke is in progress).
+    The minimum interval between two updates follows the measured inference latency, so that updates are never
+    produced faster than the inference engine can process them.
+    """
+    def __init__(self, min_interval=0.05, latency_factor=1.):
+        """
+        :param min_interval: (float) minimum interval between updates, in seconds
+        :param latency_factor: (float) interval, as a multiple of the median inference latency
+        """
+        self.min_interval = min_interval
+        self.latency_factor = latency_factor
+        self.last = 0.
+
+    def interval(self):
+        latency = metrics.registry.histogram('inference')['p50'] / 1000
+        return max(self.min_interval, self.latency_factor * latency)
+
+    def remaining(self):
+        """
+        Time (s) before the next update is allowed
+        """
+        return max(0., self.last + self.interval() - time.perf_counter())
+
+    def mark(self):
+        self.last = time.perf_counter()
+
+
+class QualityController:
+    """
+    Adapts the working quality to keep the inference latency close to a target (frame rate budget).
+
+    Quality levels reduce the number of steps first, then the working resolution (the output is upscaled for
+    display). The level changes with some hysteresis, based on the last measured latencies. The capture interval
+    follows the latency, so that capture ticks are not faster than what can be processed.
+    """
+    # (steps factor, resolution scale), from full quality to the fastest
+    levels = [(1., 1.), (0.75, 1.), (0.5, 1.), (0.5, 0.75), (0.25, 0.75), (0.25, 0.5)]
+
+    def __init__(self, target_fps=4., min_steps=1, window=5, min_capture_interval=50):
+        self.target_fps = target_fps
+        self.min_steps = min_steps
+        self.min_capture_interval = min_capture_interval  # ms
+        self.latencies = deque(maxlen=window)
+        self.level = 0
+        self.cooldown = 0
+
+    @property
+    def target_latency(self):
+        return 1 / self.target_fps
+
+    def reset(self):
+        self.level = 0
+        self.latencies.clear()
+        self.cooldown = 0
+
+    def update(self, latency):
+        """
+        Records the latency (s) of a degraded or full quality inference and changes the level if needed
+        """
+        self.latencies.append(latency)
+        if self.cooldown > 0:
+            # let the new level be measured before changing again
+            self.cooldown -= 1
+            return
+
+        median = sorted(self.latencies)[len(self.latencies) // 2]
+        if median > 1.2 * self.target_latency and self.level < len(self.levels) - 1:
+            self.level += 1
+        elif median < 0.6 * self.target_latency and self.level > 0:
+            self.level -= 1
+        else:
+            return
+        self.latencies.clear()
+        self.cooldown = 2
+
+    def update_failed(self, latency=0.):
+        """
+        Records a failed inference: it produced no frame within the budget, it counts as over budget
+        """
+        self.update(max(latency, 2 * self.target_latency))
+
+    def apply(self, steps, size, strength=1.):
+        """
+        Returns the (steps, working size) for the current level
+        :param strength: img2img strength, the pipeline runs int(steps * strength) denoising steps
+        """
+        steps_factor, scale = self.levels[self.level]
+        steps = max(self.min_steps, round(steps * steps_factor))
+        # at least one denoising step is left, otherwise img2img has no timestep to run
+        while strength > 0 and int(steps * strength) < 1:
+            steps += 1
+        # multiples of 8 for the VAE
+        w, h = size
+        w = max(64, int(w * scale) // 8 * 8)
+        h = max(64, int(h * scale) // 8 * 8)
+        return steps, (w, h)
+
+    def is_degraded(self):
+        return self.level > 0
+
+    def capture_interval(self, default):
+        """
+        Capture interval (ms) matching the measured latency
+        """
+        if not self.latencies:
+            return default
+        median = sorted(self.latencies)[len(self.latencies) // 2]
+        return max(self.min_capture_interval, int(median * 1000))
+
+
+class TaskWorker(QThread):
+    """
+    Runs background tasks (e.g. full quality exports, pre-images, warm-ups) one at a time, in submission order.
+    A task is identified by a key: a task already waiting is not queued again.
+    """
+    taskDone = Signal(object, object)  # (key, value returned by the task)
+    taskFailed = Signal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._mutex = QMutex()
+        self._condition = QWaitCondition()
+        self._tasks = deque()
+        self._keys = set()
+        self._running = True
+
+    def submit(self, key, task):
+        """
+        :param key: hashable task identifier
+        :param task: function without argument
+        """
+        with QMutexLocker(self._mutex):
+            if key in self._keys:
+                return
+            self._keys.add(key)
+            self._tasks.append((key, task))
+            self._condition.wakeOne()
+
+    def clear(self):
+        with QMutexLocker(self._mutex):
+            self._tasks.clear()
+            self._keys.clear()
+
+    def stop(self):
+        with QMutexLocker(self._mutex):
+            self._running = False
+            self._tasks.clear()
+            self._condition.wakeAll()
+        self.wait()
+
+    def run(self):
+        while True:
+            self._mutex.lock()
+            while not self._tasks and self._running:
+                self._condition.wait(self._mutex)
+            if not self._running:
+                self._mutex.unlock()
+                break
+            key, task = self._tasks.popleft()
+            self._mutex.unlock()
+
+            try:
+                result = task()
+            except Exception as e:
+                self.taskFailed.emit(str(e))
+            else:
+                self.taskDone.emit(key, result)
+            finally:
+                with QMutexLocker(self._mutex):
+                    self._keys.discard(key)